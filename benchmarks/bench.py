@@ -0,0 +1,314 @@
+from benchmarks.stub_server import StubAmazon, arguments
+from scrapers.scraper import Amazon
+import scrapers.scraper as scraper
+from tools.tool import Response, flat
+from tools.transport import transport
+from tools.limiter import limiter
+from tools.hedging import hedging, DEFAULT_TIMEOUT
+import contextlib
+import contextvars
+import statistics
+import threading
+import resource
+import tempfile
+import asyncio
+import json
+import time
+import os
+
+
+# Seconds spent fetching inside the instrumented call currently running in this task:
+_fetch_time = contextvars.ContextVar('fetch_time', default = None)
+
+
+def percentile(samples, pct):
+    """
+    Returns the given percentile of a list of samples using the nearest-rank method.
+
+    Args:
+        -samples (list): The measured values.
+        -pct (float): The percentile to compute, between 0 and 100.
+
+    Returns:
+        -float: The percentile value, or 0.0 if there are no samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summary(samples):
+    """
+    Summarizes latency samples in milliseconds.
+    """
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 2) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 99) * 1000, 2),
+        'max_ms': round(max(samples) * 1000, 2) if samples else 0.0,
+    }
+
+
+class Stages:
+    """
+    Records per-stage latencies (fetch, parse, export) of the scraper while a benchmark runs.
+
+    Fetch time is measured around 'Response.content'. Parse time is the time spent in 'product_urls' and
+    'scrape_product_info' minus the fetches they made, so it includes time spent waiting for the event loop while
+    other pages are parsed. Export time is measured around 'export_sheet'.
+    """
+
+
+    def __init__(self):
+        self.samples = {'fetch': [], 'parse': [], 'export': []}
+        self.pages = 0
+
+
+    def wrap_fetch(self, content):
+        async def timed_content(response, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await content(response, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.samples['fetch'].append(elapsed)
+                accumulated = _fetch_time.get()
+                if accumulated is not None:
+                    accumulated[0] += elapsed
+        return timed_content
+
+
+    def wrap_page(self, method):
+        async def timed_method(amazon, url, *args, **kwargs):
+            accumulated = [0.0]
+            _fetch_time.set(accumulated)
+            start = time.perf_counter()
+            result = await method(amazon, url, *args, **kwargs)
+            self.samples['parse'].append(time.perf_counter() - start - accumulated[0])
+            self.pages += 1
+            return result
+        return timed_method
+
+
+    def wrap_export(self, export):
+        async def timed_export(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await export(*args, **kwargs)
+            finally:
+                self.samples['export'].append(time.perf_counter() - start)
+        return timed_export
+
+
+    @contextlib.contextmanager
+    def instrument(self):
+        """
+        Temporarily wraps the scraper entry points with timers.
+        """
+        originals = (Response.content, Amazon.product_urls, Amazon.scrape_product_info, scraper.export_sheet)
+        Response.content = self.wrap_fetch(Response.content)
+        Amazon.product_urls = self.wrap_page(Amazon.product_urls)
+        Amazon.scrape_product_info = self.wrap_page(Amazon.scrape_product_info)
+        scraper.export_sheet = self.wrap_export(scraper.export_sheet)
+        try:
+            yield self
+        finally:
+            Response.content, Amazon.product_urls, Amazon.scrape_product_info, scraper.export_sheet = originals
+
+
+class PeakMemory(threading.Thread):
+    """
+    Samples the resident set size of the process in the background and keeps the highest value seen.
+
+    RSS is used rather than tracemalloc because most of the parsing memory is allocated by lxml outside the Python heap,
+    and tracemalloc slows parsing down several times, which would skew the throughput numbers.
+    """
+
+
+    def __init__(self, interval = 0.01):
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as file:
+                return int(file.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # Outside Linux only the lifetime peak is available, reported in kilobytes:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, self.rss())
+            self.done.wait(self.interval)
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, self.rss())
+
+
+async def measure(name, scenario):
+    """
+    Runs a benchmark scenario and collects throughput, stage latencies and peak memory.
+
+    Args:
+        -name (str): The name of the scenario for the report.
+        -scenario (coroutine function): Receives nothing and returns the scenario's result.
+
+    Returns:
+        -dict: The measurements for the scenario.
+    """
+    stages = Stages()
+    with stages.instrument(), PeakMemory() as memory:
+        start = time.perf_counter()
+        await scenario()
+        wall = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'wall_s': round(wall, 3),
+        'pages': stages.pages,
+        'pages_per_s': round(stages.pages / wall, 2) if wall else 0.0,
+        'peak_rss_mb': round(memory.peak / 1024 / 1024, 2),
+        'stages': {stage: summary(samples) for stage, samples in stages.samples.items()},
+    }
+
+
+def report(results):
+    """
+    Prints the benchmark results as a table.
+    """
+    print(f"{'scenario':<22}{'wall s':>9}{'pages':>7}{'pages/s':>9}{'peak RSS MB':>13}   stage      count   p50 ms   p95 ms   p99 ms")
+    for result in results:
+        head = f"{result['scenario']:<22}{result['wall_s']:>9}{result['pages']:>7}{result['pages_per_s']:>9}{result['peak_rss_mb']:>13}"
+        for stage, stats in result['stages'].items():
+            print(f"{head}   {stage:<9}{stats['count']:>6}{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+            head = ' ' * 60
+
+
+async def run(args, backend):
+    """
+    Runs every scenario with one transport backend against its own stub server.
+
+    The aiohttp backend reaches the stub as a proxy over TCP. HTTP/2 can't be sent through a plain HTTP proxy, so the
+    HTTP/2 backend sends its requests to an HTTP/2 stub listening on a Unix socket instead.
+
+    Returns:
+        -tuple: The measurements of the scenarios and the stub server, holding its response and connection counts.
+    """
+    socket_dir = tempfile.TemporaryDirectory()
+    if backend == 'http2':
+        uds = os.path.join(socket_dir.name, 'stub.sock')
+        stub = StubAmazon(args.host, args.port, args.latency, args.jitter, args.error_rate, args.robot_rate, args.search_pages,
+                          uds = uds, http2 = True, capacity = args.capacity, tail_rate = args.tail_rate, tail_delay = args.tail_delay).start_in_thread()
+        transport.use('http2', uds = uds)
+        proxy = None
+    else:
+        stub = StubAmazon(args.host, args.port, args.latency, args.jitter, args.error_rate, args.robot_rate, args.search_pages,
+                          capacity = args.capacity, tail_rate = args.tail_rate, tail_delay = args.tail_delay).start_in_thread()
+        transport.use('aiohttp')
+        proxy = stub.proxy
+    if args.adaptive:
+        limiter.enable()
+    hedging.set_timeout(args.timeout)
+    if args.hedge:
+        # The stub is the only proxy, duplicates go through it again on a new connection:
+        hedging.enable(warmup = 10)
+    base_url = f"http://www.amazon.{args.domain}/s?k=gaming+headset"
+    results = []
+    try:
+        amazon = Amazon(base_url, proxy)
+
+        # The scraper sleeps up to 'rand_time' seconds between product pages to be polite, which is pointless against the stub:
+        amazon.rand_time = 0
+
+        pages = await amazon.split_url()
+        product_urls = []
+
+        async def search_pages():
+            product_urls.extend(flat(await asyncio.gather(*[amazon.product_urls(url) for url in pages])))
+        results.append(await measure('product_urls', search_pages))
+
+        async def product_pages():
+            await asyncio.gather(*[amazon.scrape_product_info(url) for url in product_urls[:args.products]])
+        results.append(await measure('scrape_product_info', product_pages))
+
+        # Export into a scratch directory so benchmark runs don't litter the working tree with CSV files:
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            try:
+                results.append(await measure('export_csv', amazon.export_csv))
+            finally:
+                os.chdir(cwd)
+    finally:
+        await transport.close()
+        stub.stop_thread()
+        socket_dir.cleanup()
+    return results, stub
+
+
+async def main(args):
+    backends = ('aiohttp', 'http2') if args.backend == 'both' else (args.backend,)
+    runs = {}
+    for backend in backends:
+        results, stub = await run(args, backend)
+        answered = sum(stub.served.values())
+        runs[backend] = {
+            'results': results,
+            'stub_responses': stub.served,
+            'connections': stub.connections,
+            'peak_connections': stub.peak_connections,
+            'robot_check_rate': round(stub.served['robot'] / answered, 4) if answered else 0.0,
+        }
+        print(f"\nTransport: {backend}")
+        report(results)
+        print(f"Stub responses: {stub.served}")
+        print(f"Connections opened: {stub.connections} | peak open: {stub.peak_connections}")
+        if args.adaptive:
+            runs[backend]['concurrency_limit'] = {domain: round(state.limit, 2) for domain, state in limiter.domains.items()}
+            print(f"Adaptive concurrency limit at the end: {runs[backend]['concurrency_limit']}")
+        if args.hedge:
+            runs[backend]['hedges'] = hedging.hedges
+            print(f"Duplicated requests: {hedging.hedges} of {hedging.requests}")
+
+    if len(runs) > 1:
+        print(f"\n{'transport':<12}{'product pages/s':>17}{'connections':>13}{'peak open':>11}{'robot rate':>12}")
+        for backend, run_ in runs.items():
+            products = next(result for result in run_['results'] if result['scenario'] == 'scrape_product_info')
+            print(f"{backend:<12}{products['pages_per_s']:>17}{run_['connections']:>13}{run_['peak_connections']:>11}{run_['robot_check_rate']:>12}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'config': vars(args), 'transports': runs}, file, indent = 2)
+        print(f"Results saved to {args.json}.")
+    return runs
+
+
+if __name__ == '__main__':
+    parser = arguments()
+    parser.description = "Benchmark the scraper offline against synthetic Amazon pages."
+    parser.set_defaults(port = 0)
+    parser.add_argument('--domain', default = 'com', help = "Amazon domain to emulate, e.g. com, co.uk, de.")
+    parser.add_argument('--products', type = int, default = 48, help = "Number of product pages to scrape in the product scenario.")
+    parser.add_argument('--json', help = "Write the results to this JSON file for later comparison.")
+    parser.add_argument('--adaptive', action = 'store_true', help = "Let the adaptive concurrency controller limit the requests in flight.")
+    parser.add_argument('--hedge', action = 'store_true', help = "Duplicate requests still unanswered at the hedging deadline.")
+    parser.add_argument('--timeout', type = float, default = DEFAULT_TIMEOUT, help = "Abandon and retry requests taking longer than this many seconds.")
+    parser.add_argument('--backend', choices = ('aiohttp', 'http2', 'both'), default = 'aiohttp', help = "Transport backend to benchmark, or both to compare them.")
+    asyncio.run(main(parser.parse_args()))
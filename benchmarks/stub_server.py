@@ -0,0 +1,399 @@
+from aiohttp import web
+import h2.connection
+import h2.exceptions
+import h2.config
+import h2.events
+import threading
+import argparse
+import asyncio
+import secrets
+import gzip
+import os
+
+
+# Directory holding the synthetic Amazon pages served by the stub server. They follow the markup the selectors expect, but
+# their text and scripts are generated, and the product details block ("div#ppd") closes after about 16 KB of the 182 KB
+# product page. Results measured on them, early stops especially, can differ on real Amazon pages:
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_pages')
+
+
+def load_fixture(name):
+    """
+    Reads a synthetic HTML page from the fixtures directory.
+
+    Args:
+        -name (str): The file name of the fixture, e.g. "search.html".
+
+    Returns:
+        -bytes: The raw content of the fixture.
+    """
+    with open(os.path.join(FIXTURES, name), 'rb') as file:
+        return file.read()
+
+
+class StubAmazon:
+    """
+    A local aiohttp server that serves synthetic Amazon pages.
+
+    The server behaves like a plain HTTP forward proxy, so the scraper can be pointed at it by using "http://www.amazon.<domain>"
+    URLs together with "http://<host>:<port>" as the proxy. Product links built by the scraper then keep hitting the stub.
+    It can also listen on a Unix socket that the transports send every request to, and speak HTTP/2 without TLS (h2c)
+    instead of HTTP/1.1, to compare the transport backends.
+
+    Args:
+        - host (str): The interface to bind the server to.
+        - port (int): The port to listen on, 0 picks a free port.
+        - latency (float): The mean response delay in milliseconds.
+        - jitter (float): The maximum random deviation from the mean delay in milliseconds.
+        - error_rate (float): The fraction of requests answered with a 503 page.
+        - robot_rate (float): The fraction of requests answered with the robot check (captcha) page.
+        - search_pages (int): The number of result pages the search fixture advertises in its pagination strip.
+        - uds (str): A Unix socket to listen on instead of host and port.
+        - http2 (bool): Serve HTTP/2 with prior knowledge instead of HTTP/1.1.
+        - capacity (int): The number of requests the stub can serve at once, requests beyond it get a 503 page like an
+          overloaded Amazon host. None for no limit.
+        - tail_rate (float): The fraction of requests that hang like a request stuck on a slow free proxy.
+        - tail_delay (float): How long those requests hang, in milliseconds.
+    """
+
+
+    def __init__(self, host = '127.0.0.1', port = 0, latency = 50, jitter = 20, error_rate = 0.0, robot_rate = 0.0, search_pages = 5,
+                 uds = None, http2 = False, capacity = None, tail_rate = 0.0, tail_delay = 5000):
+        self.host = host
+        self.port = port
+        self.uds = uds
+        self.http2 = http2
+        self.capacity = capacity
+        self.in_flight = 0
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_delay = tail_delay
+        self.error_rate = error_rate
+        self.robot_rate = robot_rate
+        # The synthetic search page advertises 5 result pages, rewrite the last page number to change the crawl size:
+        search = load_fixture('search.html').replace(b'aria-disabled="true">5<', f'aria-disabled="true">{search_pages}<'.encode())
+        self.pages = {
+            'search': search,
+            'product': load_fixture('product.html'),
+            'robot': load_fixture('robot_check.html'),
+            'unavailable': load_fixture('service_unavailable.html'),
+        }
+        # Pages are compressed once up front, so serving them costs the stub as little as possible:
+        self.compressed = {page: gzip.compress(body) for page, body in self.pages.items()}
+        # Number of responses served per outcome, handy to cross-check benchmark results:
+        self.served = {'search': 0, 'product': 0, 'robot': 0, 'unavailable': 0, 'not_found': 0}
+        # Client connections accepted over the server's lifetime, and the most that were open at once:
+        self.connections = 0
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.runner = None
+        self.server = None
+        # Open HTTP/2 connections, closed when the server stops:
+        self.h2_connections = set()
+        self.thread = None
+
+
+    @property
+    def proxy(self):
+        """
+        Returns the proxy URL the scraper should use to reach the stub server.
+        """
+        return f"http://{self.host}:{self.port}"
+
+
+    async def delay(self):
+        """
+        Sleeps for the configured latency plus a random jitter, or for the tail delay at the tail rate.
+        """
+        if self.roll(self.tail_rate):
+            await asyncio.sleep(self.tail_delay / 1000)
+            return
+        jitter = (secrets.randbelow(2001) - 1000) / 1000 * self.jitter
+        await asyncio.sleep(max(self.latency + jitter, 0) / 1000)
+
+
+    def roll(self, rate):
+        """
+        Returns True with the given probability.
+        """
+        return secrets.randbelow(10_000) < rate * 10_000
+
+
+    async def pick(self, path, accept_encoding = ''):
+        """
+        Picks the fixture matching a requested path, injecting 503 and robot check pages at the configured rates.
+
+        Args:
+            -path (str): The path of the request.
+            -accept_encoding (str): The Accept-Encoding header of the request.
+
+        Returns:
+            -tuple: The status, the body and whether the body is gzip compressed. The body is None for unknown paths.
+        """
+        self.in_flight += 1
+        try:
+            await self.delay()
+            overloaded = self.capacity is not None and self.in_flight > self.capacity
+        finally:
+            self.in_flight -= 1
+
+        if overloaded or self.roll(self.error_rate):
+            page, status = 'unavailable', 503
+        elif self.roll(self.robot_rate):
+            page, status = 'robot', 200
+        elif '/dp/' in path:
+            page, status = 'product', 200
+        elif path.startswith(('/s', '/b')):
+            page, status = 'search', 200
+        else:
+            self.served['not_found'] += 1
+            return 404, None, False
+
+        self.served[page] += 1
+        # Compress the body the same way Amazon does when the client asks for it:
+        if 'gzip' in accept_encoding:
+            return status, self.compressed[page], True
+        return status, self.pages[page], False
+
+
+    def opened(self):
+        self.connections += 1
+        self.open_connections += 1
+        self.peak_connections = max(self.peak_connections, self.open_connections)
+
+
+    def closed(self):
+        self.open_connections -= 1
+
+
+    async def handle(self, request):
+        """
+        Answers an HTTP/1.1 request with the fixture picked for its path.
+        """
+        status, body, compressed = await self.pick(request.path, request.headers.get('Accept-Encoding', ''))
+        if body is None:
+            return web.Response(status = 404)
+        headers = {'Content-Encoding': 'gzip'} if compressed else None
+        return web.Response(body = body, status = status, headers = headers, content_type = 'text/html', charset = 'utf-8')
+
+
+    async def start(self):
+        """
+        Starts the stub server in the running event loop.
+        """
+        if self.http2:
+            loop = asyncio.get_running_loop()
+            if self.uds:
+                self.server = await loop.create_unix_server(lambda: H2Connection(self), self.uds)
+            else:
+                self.server = await loop.create_server(lambda: H2Connection(self), self.host, self.port)
+                self.port = self.server.sockets[0].getsockname()[1]
+            return self
+
+        app = web.Application()
+        app.router.add_route('GET', '/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+        # Count the connections of the HTTP/1.1 server as its request handlers report them:
+        server = self.runner.server
+        made, lost = server.connection_made, server.connection_lost
+
+        def connection_made(handler, transport):
+            self.opened()
+            made(handler, transport)
+
+        def connection_lost(handler, exc = None):
+            self.closed()
+            lost(handler, exc)
+
+        server.connection_made, server.connection_lost = connection_made, connection_lost
+        if self.uds:
+            site = web.UnixSite(self.runner, self.uds)
+            await site.start()
+        else:
+            site = web.TCPSite(self.runner, self.host, self.port)
+            await site.start()
+
+            # Resolve the port actually bound when 0 was requested:
+            self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+
+    async def stop(self):
+        """
+        Shuts the stub server down.
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.server is not None:
+            self.server.close()
+            for connection in list(self.h2_connections):
+                connection.transport.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+    def start_in_thread(self):
+        """
+        Runs the stub server on its own event loop in a background thread.
+
+        Benchmarks use this so that CPU-bound parsing in the scraper's event loop can't delay the stub's responses.
+        """
+        ready = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        def run():
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self.thread = threading.Thread(target = run, name = 'stub-amazon', daemon = True)
+        self.thread.start()
+        ready.wait()
+        self.loop = loop
+        return self
+
+
+    def stop_thread(self):
+        """
+        Stops a stub server started with 'start_in_thread'.
+        """
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+
+class H2Connection(asyncio.Protocol):
+    """
+    One HTTP/2 connection of the stub server, answering every stream with the fixture picked for its path.
+
+    Args:
+        - stub (StubAmazon): The server the connection belongs to.
+    """
+
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side = False, header_encoding = 'utf-8'))
+        self.transport = None
+        # Bodies still waiting for flow control credit, by stream:
+        self.pending = {}
+        self.tasks = set()
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stub.opened()
+        self.stub.h2_connections.add(self)
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+
+    def connection_lost(self, exc):
+        self.stub.closed()
+        self.stub.h2_connections.discard(self)
+        for task in self.tasks:
+            task.cancel()
+
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                task = asyncio.ensure_future(self.respond(event.stream_id, dict(event.headers)))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            elif isinstance(event, h2.events.StreamReset):
+                # The client stopped reading the page early:
+                self.pending.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.WindowUpdated):
+                self.flush()
+        self.transport.write(self.conn.data_to_send())
+
+
+    async def respond(self, stream_id, headers):
+        status, body, compressed = await self.stub.pick(headers.get(':path', '/'), headers.get('accept-encoding', ''))
+        response = [(':status', str(status)), ('content-type', 'text/html; charset=utf-8'), ('content-length', str(len(body or b'')))]
+        if compressed:
+            response.append(('content-encoding', 'gzip'))
+        try:
+            self.conn.send_headers(stream_id, response, end_stream = not body)
+        except h2.exceptions.StreamClosedError:
+            return
+        if body:
+            self.pending[stream_id] = body
+        self.flush()
+
+
+    def flush(self):
+        """
+        Sends as much of the pending bodies as the flow control windows allow.
+        """
+        for stream_id, body in list(self.pending.items()):
+            try:
+                while body:
+                    size = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size, len(body))
+                    if size <= 0:
+                        break
+                    self.conn.send_data(stream_id, body[:size])
+                    body = body[size:]
+                if body:
+                    self.pending[stream_id] = body
+                else:
+                    self.conn.end_stream(stream_id)
+                    del self.pending[stream_id]
+            except h2.exceptions.StreamClosedError:
+                self.pending.pop(stream_id, None)
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(self.conn.data_to_send())
+
+
+async def serve(args):
+    stub = await StubAmazon(args.host, args.port, args.latency, args.jitter, args.error_rate, args.robot_rate, args.search_pages,
+                            args.uds, args.http2, args.capacity, args.tail_rate, args.tail_delay).start()
+    if args.uds:
+        print(f"Stub Amazon listening on {args.uds}, {'HTTP/2' if args.http2 else 'HTTP/1.1'}. Send http://www.amazon.com/... requests to that socket.")
+    else:
+        print(f"Stub Amazon listening on {stub.proxy}. Use it as the proxy for http://www.amazon.com/... URLs.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+def arguments(parser = None):
+    """
+    Adds the stub server options to an argument parser.
+    """
+    parser = parser or argparse.ArgumentParser(description = "Serve synthetic Amazon pages from a local server.")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--latency', type = float, default = 50, help = "Mean response delay in milliseconds.")
+    parser.add_argument('--jitter', type = float, default = 20, help = "Maximum deviation from the mean delay in milliseconds.")
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = "Fraction of requests answered with a 503 page.")
+    parser.add_argument('--robot-rate', type = float, default = 0.0, help = "Fraction of requests answered with the robot check page.")
+    parser.add_argument('--search-pages', type = int, default = 5, help = "Number of result pages the search fixture advertises.")
+    parser.add_argument('--capacity', type = int, default = None, help = "Requests served at once before answering with 503 pages.")
+    parser.add_argument('--tail-rate', type = float, default = 0.0, help = "Fraction of requests that hang for the tail delay.")
+    parser.add_argument('--tail-delay', type = float, default = 5000, help = "How long the tail requests hang in milliseconds.")
+    parser.add_argument('--uds', help = "Listen on this Unix socket instead of host and port.")
+    parser.add_argument('--http2', action = 'store_true', help = "Serve HTTP/2 without TLS (h2c) instead of HTTP/1.1.")
+    return parser
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(arguments().parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,5 +1,13 @@
-from mongo_database.mongo import export_to_mong
 from tools.tool import rand_proxies
+from tools.metrics import metrics
+from tools.trace import tracer
+from tools.archive import archive
+from tools.transport import transport
+from tools.images import images
+from tools.changes import changes
+from sqlite_database.store import store
+from tools.limiter import limiter
+from tools.hedging import hedging
 from scrapers.scraper import Amazon
 import asyncio
 import time
@@ -10,6 +18,55 @@ if __name__ == '__main__':
 
     async def main():
         base_url = "https://www.amazon.ae/b/ref=sv_sl_mm_en_5_4_1_6/b/?_encoding=UTF8&node=11995864031&ref=sr_nr_n_1&pd_rd_w=ULvh4&content-id=amzn1.sym.a7286ae0-0314-49ff-8182-f95ea0dbfa34&pf_rd_p=a7286ae0-0314-49ff-8182-f95ea0dbfa34&pf_rd_r=BDMYA61G3Z69H9ATC5BG&pd_rd_wg=NsD6b&pd_rd_r=3fc3f3bb-0ddc-4bd9-96a4-cc1dd7a3c859&ref_=pd_gw_unk"
+        # Type True if you want to watch live Prometheus metrics on http://localhost:9100/metrics while the scraper runs:
+        live_metrics = False
+        if live_metrics:
+            await metrics.serve(9100)
+
+        # Type True if you want to write one trace event per URL to trace.jsonl, summarize it with "python -m tools.trace trace.jsonl":
+        trace = False
+        if trace:
+            tracer.enable('trace.jsonl')
+
+        # Type True if you want to keep every fetched page in "Amazon archive", re-extract it later with "python -m tools.archive reextract 'Amazon archive'":
+        archive_pages = False
+        if archive_pages:
+            archive.open('Amazon archive')
+
+        # Type True if you want to multiplex the requests over a few HTTP/2 connections instead of opening one connection per request:
+        http2 = False
+        if http2:
+            transport.use('http2')
+
+        # Type True if you want to download the product images and thumbnails into "Amazon images", linked to the ASIN of every record:
+        download_images = False
+        if download_images:
+            images.open('Amazon images')
+
+        # Type True if you want every export to also append its new, removed and modified products to a JSONL feed in "Amazon changes":
+        change_feed = False
+        if change_feed:
+            changes.open('Amazon changes')
+
+        # Type True if you want to keep the latest state and price history of every product in "Amazon database/products.sqlite":
+        sqlite_store = False
+        if sqlite_store:
+            store.open('Amazon database//products.sqlite')
+
+        # Type True if you want the crawl to adapt the number of requests in flight per domain to Amazon's 503s, robot checks and latency:
+        adaptive_concurrency = False
+        if adaptive_concurrency:
+            limiter.enable()
+
+        # Type the number of seconds after which a request is abandoned and retried, or None to wait as long as the connection stays open:
+        request_timeout = 30
+        hedging.set_timeout(request_timeout)
+
+        # Type True if you want requests still unanswered at the 95th percentile latency to be duplicated through another proxy of "tools/proxies.txt":
+        hedge_requests = False
+        if hedge_requests:
+            hedging.enable(proxies = lambda: f"http://{rand_proxies()}")
+
         status = await Amazon(base_url, None).status()
 
         if status == 503:
@@ -21,12 +78,14 @@ if __name__ == '__main__':
         proxy = False
         if csv:
             if proxy:
-                amazon = Amazon(base_url, None)
+                amazon = Amazon(base_url, f"http://{rand_proxies()}")
                 return await amazon.export_csv()
             else:
-                amazon = Amazon(base_url, f"http://{rand_proxies()}")
+                amazon = Amazon(base_url, None)
                 return await amazon.export_csv()
         else:
+            # Imported here so that CSV runs don't load pymongo:
+            from mongo_database.mongo import export_to_mong
             if proxy:
                 mongo_to_db = await export_to_mong(base_url, f"http://{rand_proxies()}")
             else:
@@ -34,13 +93,28 @@ if __name__ == '__main__':
             return mongo_to_db
 
 
+    async def scrape():
+        # Close the pooled HTTP/2 connections and the image downloads before the event loop goes away:
+        try:
+            return await main()
+        finally:
+            await images.close()
+            await transport.close()
+
+
     # Start the timer to measure how long the wb scraping process takes
     start_time = time.time()
     # Run the async main function and run the scraper:
-    results = asyncio.run(main())
+    results = asyncio.run(scrape())
     end_time = time.time()
     print(results)
     # Calculate and print the total time taken to scrape the data:D
     execution_time = round(end_time - start_time, 2)
     print(f"Took {execution_time} seconds | {round(execution_time / 60, 2)} minutes.")
 
+    # Save the latency, retry, status and export numbers of the run:
+    metrics.save('metrics.json')
+    tracer.close()
+    archive.close()
+    store.close()
+
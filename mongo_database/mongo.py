@@ -1,4 +1,8 @@
 from tools.tool import flat, export_sheet, region
+from tools.metrics import metrics, host
+from tools.trace import tracer
+from tools.changes import changes
+from sqlite_database.store import store
 from scrapers.scraper import Amazon
 import pymongo as mong
 
@@ -33,8 +37,14 @@ async def export_to_mong(url, proxy):
     # Scrape and save product information concurrently:
     datas = await amazon.concurrency()
 
+    # Append what changed since the previous export of the collection to its change feed, before MongoDB adds its ids:
+    changes.emit(collection_name, flat(datas), host(url))
+    store.write(flat(datas), collection_name.split(' - ', 1)[-1], host(url))
+
     # Insert the scraped data into the MongoDB collection:
     result = collection.insert_many(flat(datas))
+    metrics.inc('amazon_records_exported_total', len(result.inserted_ids), domain = host(url), sink = 'mongo')
+    tracer.sink('mongo')
 
     # Close the MongoDB connection:
     client.close()
@@ -1,12 +1,7 @@
-from scrapers.scraper import Amazon
-from dotenv import load_dotenv
-import mysql.connector
+from scrapers.scraper import lookup_asins
 import os
 
 
-load_dotenv(f"{os.getcwd()}//environmentVariables//.env")
-
-
 async def mysql_connections():
     """
     Establishes a connection to the MySQL database using environment variables.
@@ -14,6 +9,11 @@ async def mysql_connections():
     Returns:
         -cnx: MySQL connection object.
     """
+    # Loaded on the first connection, so importing this module doesn't pull in the MySQL driver:
+    from dotenv import load_dotenv
+    import mysql.connector
+
+    load_dotenv(f"{os.getcwd()}//environmentVariables//.env")
     cnx = mysql.connector.connect(
         host = os.getenv('DB_HOST'),
         port = os.getenv('PORT'),
@@ -47,12 +47,13 @@ async def verifyASIN(amazon_asin):
         return
 
 
-async def export_to_db(amazon_asin, user = None):
+async def export_to_db(amazon_asin, user = None, region = 'USA'):
     """
     Exports data for a given Amazon ASIN/ISBN to the databse.
     
     Args:
         -amazon_asin: Amazon ASIN of the product to export.
+        -region: The Amazon site to look the product up on, e.g. "USA" or "UK".
         
     Returns:
         -Dictionary containing the data for the product if it's already existed in the database,
@@ -70,7 +71,12 @@ async def export_to_db(amazon_asin, user = None):
         cnx.close()
         return result_dict
     else:        
-        amazon_datas = await Amazon().dataByAsin(amazon_asin)
+        asin = amazon_asin.strip().upper()
+        records, errors = await lookup_asins([asin], region, rand_time = 0)
+        if asin not in records:
+            cnx.close()
+            raise Exception(f"Failed to look up {asin}: {errors[asin]}")
+        amazon_datas = records[asin]
         insert_query = f"""INSERT INTO `asin_collections` (`ASIN`, `Name`, `Price`, `Rating`, `Rating count`, `Availability`, `Hyperlink`, `Image`, `Store`, `Store link`) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
         values = (amazon_asin, amazon_datas['Name'], amazon_datas['Price'], amazon_datas['Rating'], amazon_datas['Rating count'], amazon_datas['Availability'], amazon_datas['Hyperlink'], amazon_datas['Image'], amazon_datas['Store'], amazon_datas['Store link'])
         cursor.execute(insert_query, values)
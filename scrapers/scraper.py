@@ -1,10 +1,51 @@
-from tools.tool import TryExcept, Response, yaml_load, randomTime, userAgents, verify_amazon, flat, region, export_sheet, domain
-from bs4 import BeautifulSoup
-import pandas as pd
+from tools.tool import TryExcept, Response, yaml_load, randomTime, userAgents, verify_amazon, flat, region, export_sheet, domain, origin, region_origin
+from tools.metrics import metrics, host, retry_cause
+from tools.trace import tracer
+from tools.fallbacks import Fallbacks
+from tools.images import images
+from tools.changes import changes
+from sqlite_database.store import store
+import http.client
 import asyncio
+import time
 import re
 
 
+# Statuses a lookup gives up on at once, as the page doesn't exist or won't be served whatever the number of retries:
+FINAL_STATUSES = tuple(status for status in range(400, 500) if status not in (408, 429))
+
+
+def make_soup(content):
+    """
+    Parses an HTML page with BeautifulSoup and lxml.
+
+    Args:
+        - content (bytes): The page.
+
+    Returns:
+        - BeautifulSoup: The parsed page.
+    """
+    # Imported on first parse, so that importing the scraper doesn't load BeautifulSoup and lxml:
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, 'lxml')
+
+
+class PageError(Exception):
+    """
+    Raised by 'scrape_product_info' when a product page can't be scraped.
+
+    Attributes:
+        - cause (str): The cause of the last failed attempt, as classified by 'retry_cause'.
+        - attempts (int): The number of attempts made.
+    """
+
+
+    def __init__(self, message, cause, attempts):
+        super().__init__(message)
+        self.cause = cause
+        self.attempts = attempts
+
+
 class Amazon:
     """
     Initializes an instance of the Amazon class.
@@ -16,13 +57,17 @@ class Amazon:
     Attributes:
         - proxy: The proxy to be used for making requests.
         - country_domain: The domain of the country derived from the base URL.
+        - origin (str): The scheme and host of the base URL, used to build absolute product and store links.
         - region: The region derived from the base URL.
         - currency (str): A regular expression pattern for currencies in different regions.
         - rand_time (int): The random time interval in seconds.
         - base_url (str): The base URL for Amazon.
         - headers (dict): A dictionary containing the user agent to be used in the request headers.
+        - product_fields (list): The selectors of the product page fields, used to stop downloading a product page early.
+        - max_page_bytes (int): The maximum number of bytes read from a product page.
         - catch (TryExcept): An instance of TryExcept class, used for catching exceptions.
         - scrape (yaml_load): An instance of the yaml_load class, used for selecting page elements to be scraped.
+        - fallbacks (Fallbacks): Finds the fields that have fallback chains of selectors in selector.yaml.
     """
 
 
@@ -32,6 +77,7 @@ class Amazon:
         """
         self.proxy = proxy
         self.country_domain = domain(base_url)
+        self.origin = origin(base_url)
         self.region = region(base_url)
 
         # Define a regular expression pattern for currencies in different regions
@@ -56,6 +102,13 @@ class Amazon:
         self.headers = {'User-Agent': userAgents()}
         self.catch = TryExcept()
         self.scrape = yaml_load('selector')
+        self.fallbacks = Fallbacks(self.scrape, self.region, host(base_url))
+
+        # Product pages are streamed and the download stops once these fields have arrived, or after 'max_page_bytes':
+        self.product_fields = [self.fallbacks.alternatives(field) for field in ('name', 'image_link', 'availability', 'product_price', 'deal_price',
+                                                                                'savings', 'review', 'rating_count', 'store', 'description',
+                                                                                'prod_des', 'image_lists')]
+        self.max_page_bytes = 2 * 1024 * 1024
 
 
     async def status(self):
@@ -65,7 +118,7 @@ class Amazon:
         Returns:
             - int: The HTTP response status code.
         """
-        response = await Response(self.base_url).response()
+        response = await Response(self.base_url, self.proxy).response()
         return response
 
 
@@ -80,9 +133,10 @@ class Amazon:
             int: The number of pages of search results.
         """
         for retry in range(max_retries):
+            response = Response(self.base_url, self.proxy)
             try:
-                content = await Response(self.base_url).content()
-                soup = BeautifulSoup(content, 'lxml')
+                content = await response.content()
+                soup = make_soup(content)
 
                 # Try except clause for index error, this happens if there are only one page:
                 try:
@@ -95,11 +149,13 @@ class Amazon:
                     return int(pages)
                 except ValueError:
                     return 2
-            except ConnectionResetError as se:
+            except ConnectionResetError as e:
+                metrics.inc('amazon_retries_total', domain = host(self.base_url), cause = retry_cause(e, response))
                 print(f"Connection lost: {str(e)}. Retrying... ({retry + 1} / {max_retries})")
                 if retry < max_retries - 1:
                     await asyncio.sleep(5)  # Delay before retrying.
             except Exception as e:
+                metrics.inc('amazon_retries_total', domain = host(self.base_url), cause = retry_cause(e, response))
                 print(f"Retry {retry + 1} failed: {str(e)}")
                 if retry < max_retries - 1:
                     await asyncio.sleep(4)  # Delay before retrying.
@@ -122,12 +178,12 @@ class Amazon:
         total_pages = await self.num_of_pages()
 
         # Use the 'static_connection' method to make a static connection to the given URL and get its HTML content:
-        content = await Response(self.base_url).content()
+        content = await Response(self.base_url, self.proxy).content()
         # Making a soup:
-        soup = BeautifulSoup(content, 'lxml')
+        soup = make_soup(content)
 
         # Get the URL of the next button on the search result page and costruct the URL of the next search result page:
-        next_link = f"""https://www.amazon.{self.country_domain}{await self.catch.attributes(soup.select_one(self.scrape['next_button']), 'href')}"""
+        next_link = f"""{self.origin}{await self.catch.attributes(soup.select_one(self.scrape['next_button']), 'href')}"""
 
         for num in range(1, total_pages):
             # Replace the 'page' number in the URL with curren tpage number increment by 1:
@@ -161,7 +217,7 @@ class Amazon:
 
 
     async def category_name(self):
-        resp = Response(self.base_url)
+        resp = Response(self.base_url, self.proxy)
         """
         Retrieves the category name of search results on the given Amazon search page URL.
 
@@ -172,17 +228,9 @@ class Amazon:
             -None.
         """
         content = await resp.content()
-        soup = BeautifulSoup(content, 'lxml')
-        try:
-            searches_results = soup.select_one(self.scrape['searches_I']).text.strip()
-        except AttributeError:
-            try:
-                searches_results = re.sub(r'["]', '', soup.select_one(self.scrape['searches_II']).text.strip())
-            except AttributeError:
-                try:
-                    searches_results = soup.select_one(self.scrape['searches_III']).text.strip()
-                except AttributeError:
-                    searches_results = soup.select_one(self.scrape['searches_IV']).text.strip()
+        soup = make_soup(content)
+        # Raises AttributeError if none of the alternatives match:
+        searches_results = re.sub(r'["]', '', self.fallbacks.select_one(soup, 'category').text.strip())
 
         return searches_results
 
@@ -198,11 +246,15 @@ class Amazon:
             -Expecation: If there is an error while loading the content of the Amazon search results page.
         """
         url_lists = []
+        tracer.begin(url, 'search')
         for retry in range(max_retries):
+            response = Response(url, self.proxy)
             try:
                 # Use the 'static_connection' method to download the HTML content of the search results bage
-                content = await Response(url).content()
-                soup = BeautifulSoup(content, 'lxml')
+                content = await response.content()
+                parse_start = time.perf_counter()
+                tracer.mark('parse_start')
+                soup = make_soup(content)
 
                 # Check if main content element exists on page:
                 try:
@@ -210,119 +262,252 @@ class Amazon:
                 except Exception as e:
                     return f"Content loading error. Please try again in few minutes. Error message: {e}"
                 # Get product card contents from current page:
-                card_contents = [f"""https://www.amazon.{self.country_domain}{prod.select_one(self.scrape['hyperlink']).get('href')}""" for prod in soup.select(self.scrape['main_content'])]
+                card_contents = [f"""{self.origin}{prod.select_one(self.scrape['hyperlink']).get('href')}""" for prod in soup.select(self.scrape['main_content'])]
                 url_lists.append(card_contents)
+                metrics.observe('amazon_parse_seconds', time.perf_counter() - parse_start, domain = host(url), page = 'search')
+                tracer.mark('parse_end')
+                break
             except Exception as e:
+                cause = retry_cause(e, response)
+                metrics.inc('amazon_retries_total', domain = host(url), cause = cause)
+                tracer.retry(cause)
                 print(f"Retry {retry + 1} || Error: {str(e)}\n URL: {url}")
                 if retry < max_retries - 1:
                     await asyncio.sleep(5)
                 else:
+                    tracer.finish(f"failed: {cause}")
                     return f"Failed to retrieve valid data after {max_retries} retries. Scraped URLS are saved and ready for crawling process."
 
+        tracer.finish('ok')
         return flat(url_lists)
 
 
-    async def scrape_product_info(self, url, max_retries = 13):
+    async def extract_product(self, content, url):
+        """
+        Extracts the product information from the HTML content of an Amazon product page.
+
+        Args:
+            - content (bytes): The HTML content of the product page.
+            - url (str): The URL of the product page.
+
+        Returns:
+            - dict: The product information.
+
+        Raises:
+            - Exception: If the product name can't be found on the page.
+        """
+        soup = make_soup(content)
+
+        # Extract product name:
+        product = soup.select_one(self.scrape['name']).text.strip()
+
+        # Raise an exception if the product name is 'N/A':
+        if product == "N/A":
+            raise Exception("Product is 'N/A' retrying...")
+        image_link = await self.catch.attributes(self.fallbacks.select_one(soup, 'image_link'), 'src')
+        try:
+            availabilities = soup.select_one(self.scrape['availability']).text.strip()
+        except AttributeError:
+            availabilities = 'In stock'
+        # Skip alternatives that matched a pagination label instead of a price:
+        price = await self.catch.text(self.fallbacks.select_one(soup, 'product_price', lambda element: 'Page' not in element.text.split()))
+        if price != "N/A":
+            price = re.sub(self.currency, '', price)
+        try:
+            deal_price = await self.catch.text(soup.select(self.scrape['deal_price'])[0])
+            if 'Page' in deal_price.split():
+                deal_price = "N/A"
+        except Exception as e:
+            deal_price = "N/A"
+        if deal_price != "N/A":
+            deal_price = re.sub(self.currency, '', deal_price)
+        try:
+            savings = await self.catch.text(soup.select(self.scrape['savings'])[-1])
+        except IndexError:
+            savings = "N/A"
+        try:
+            ratings = float(soup.select_one(self.scrape['review']).text.strip().replace(" out of 5 stars", ''))
+        except Exception as e:
+            ratings = "N/A"
+        try:
+            rating_count = float(re.sub(r'[,\sratings]', '', soup.select_one(self.scrape['rating_count']).text.strip()))
+        except Exception as e:
+            rating_count = "N/A"
+        store = await self.catch.text(soup.select_one(self.scrape['store']))
+        store_link = f"""{self.origin}{await self.catch.attributes(soup.select_one(self.scrape['store']), 'href')}"""
+
+        # Construct the data dictionary containing product information:
+        datas = {
+            'Name': product,
+            'ASIN': await self.getASIN(url),
+            'Region': self.region,
+            'Description': ' '.join([des.text.strip() for des in soup.select(self.scrape['description'])]),
+            'Breakdown': ' '.join([br.text.strip() for br in soup.select(self.scrape['prod_des'])]),
+            'Price': price,
+            'Deal Price': deal_price,
+            'You saved': savings,
+            'Rating': ratings,
+            'Rating count': rating_count,
+            'Availability': availabilities,
+            'Hyperlink': url,
+            'Image': image_link,
+            'Images': [imgs.get('src') for imgs in soup.select(self.scrape['image_lists'])],
+            'Store': store.replace("Visit the ", ""),
+            'Store link': store_link,
+        }
+        return datas
+
+
+    async def scrape_product_info(self, url, max_retries = 13, final_statuses = ()):
         """
         Scrapes product information from the Amazon product page.
 
         Args:
             - url (str): The URL of the Amazon product page.
             - max_retries (int): The maximum number of retry attempts in case of connection errors.
+            - final_statuses (tuple): HTTP statuses that fail the page at once instead of being retried.
 
         Returns:
             - list: A list containing dictionaries with product information.
 
         Raises:
-            - Exception: If valid data cannot be retrieved after the maximum number of retry attempts.
+            - PageError: If valid data cannot be retrieved after the maximum number of retry attempts, or the page was
+              answered with one of the final statuses.
         """
         # List to store product information dictionaries:
         amazon_dicts = []
+        tracer.begin(url, 'product')
         for retry in range(max_retries):
+            response = Response(url, self.proxy)
             try:
-                # Retrieve the page content using 'static_connection' method:
-                content = await Response(url).content()
+                # Retrieve the part of the page holding the product details, the recommendations below it are skipped:
+                content = await response.content(self.product_fields, self.scrape['product_end'], self.max_page_bytes)
 
                 # Adding a random time interval between each requests
                 random_time_interval = await randomTime(self.rand_time)
+                tracer.mark('sleep_start')
                 await asyncio.sleep(random_time_interval)
+                tracer.mark('sleep_end')
 
-                soup = BeautifulSoup(content, 'lxml')
-
-                # Extract product name:
-                product = soup.select_one(self.scrape['name']).text.strip()
-                print(product)
-
-                # Raise an exception if the product name is 'N/A':
-                if product == "N/A":
-                    raise Exception("Product is 'N/A' retrying...")
-                try:
-                    # Try to extract the image link using the second first selector.
-                    image_link = soup.select_one(self.scrape['image_link_i']).get('src')
-                except Exception as e:
-                    image_link = await self.catch.attributes(soup.select_one(self.scrape['image_link_ii']), 'src')
-                try:
-                    availabilities = soup.select_one(self.scrape['availability']).text.strip()
-                except AttributeError:
-                    availabilities = 'In stock'
-                price = await self.catch.text(soup.select_one(self.scrape['price_us']))
-                if 'Page' in price.split():
-                    price = await self.catch.text(soup.select_one(self.scrape['price_us_i']))
-                if price != "N/A":
-                    price = re.sub(self.currency, '', price)
-                try:
-                    deal_price = await self.catch.text(soup.select(self.scrape['deal_price'])[0])
-                    if 'Page' in deal_price.split():
-                        deal_price = "N/A"
-                except Exception as e:
-                    deal_price = "N/A"
-                if deal_price != "N/A":
-                    deal_price = re.sub(self.currency, '', deal_price)
-                try:
-                    savings = await self.catch.text(soup.select(self.scrape['savings'])[-1])
-                except IndexError:
-                    savings = "N/A"
-                try:
-                    ratings = float(soup.select_one(self.scrape['review']).text.strip().replace(" out of 5 stars", ''))
-                except Exception as e:
-                    ratings = "N/A"
-                try:
-                    rating_count = float(re.sub(r'[,\sratings]', '', soup.select_one(self.scrape['rating_count']).text.strip()))
-                except Exception as e:
-                    rating_count = "N/A"
-                store = await self.catch.text(soup.select_one(self.scrape['store']))
-                store_link = f"""https://www.amazon.{self.country_domain}{await self.catch.attributes(soup.select_one(self.scrape['store']), 'href')}"""
-
-                # Construct the data dictionary containing product information:
-                datas = {
-                    'Name': product,
-                    'ASIN': await self.getASIN(url),
-                    'Region': self.region,
-                    'Description': ' '.join([des.text.strip() for des in soup.select(self.scrape['description'])]),
-                    'Breakdown': ' '.join([br.text.strip() for br in soup.select(self.scrape['prod_des'])]),
-                    'Price': price,
-                    'Deal Price': deal_price,
-                    'You saved': savings,
-                    'Rating': ratings,
-                    'Rating count': rating_count,
-                    'Availability': availabilities,
-                    'Hyperlink': url,
-                    'Image': image_link,
-                    'Images': [imgs.get('src') for imgs in soup.select(self.scrape['image_lists'])],
-                    'Store': store.replace("Visit the ", ""),
-                    'Store link': store_link,
-                }
+                parse_start = time.perf_counter()
+                tracer.mark('parse_start')
+                datas = await self.extract_product(content, url)
+                print(datas['Name'])
                 amazon_dicts.append(datas)
+                metrics.observe('amazon_parse_seconds', time.perf_counter() - parse_start, domain = host(url), page = 'product')
+                tracer.mark('parse_end')
                 break
             except Exception as e:
+                cause = retry_cause(e, response)
+                metrics.inc('amazon_retries_total', domain = host(url), cause = cause)
+                tracer.retry(cause)
+                if response.status in final_statuses:
+                    tracer.finish(f"failed: {cause}")
+                    raise PageError(f"HTTP {response.status}: {http.client.responses.get(response.status, 'error').lower()}", cause, retry + 1)
                 print(f"Retry {retry + 1} || Error: {str(e)}\nURL: {url}")
                 if retry < max_retries - 1:
                     await asyncio.sleep(5)
                 else:
-                    raise Exception(f"Failed to retrieve valid data after {max_retries} retries. Scraped datas are saved and exported.")
+                    tracer.finish(f"failed: {cause}")
+                    raise PageError(f"Failed to retrieve valid data after {max_retries} retries. Scraped datas are saved and exported.", cause, max_retries)
+
+        # Keep the trace event open until the record reaches a sink:
+        tracer.finish('ok', hold = True)
         return amazon_dicts
 
 
+    async def product_stage(self, url, max_retries = 13, final_statuses = ()):
+        """
+        Scrapes a product page and, when the image store is open, stores the product's images and adds their files to the record.
+
+        Args:
+            - url (str): The URL of the Amazon product page.
+            - max_retries (int): The maximum number of retry attempts in case of connection errors.
+            - final_statuses (tuple): HTTP statuses that fail the page at once instead of being retried.
+
+        Returns:
+            - list: A list containing dictionaries with product information.
+        """
+        records = await self.scrape_product_info(url, max_retries, final_statuses)
+        if images.enabled:
+            await asyncio.gather(*[images.attach(record, self.proxy) for record in records])
+        return records
+
+
+    async def lookup(self, asins, concurrency = 50, max_retries = 3):
+        """
+        Scrapes the product pages of a batch of ASINs directly, without crawling a category.
+
+        The "/dp/<ASIN>" page of every ASIN on this Amazon site is fetched and extracted like any product page of a
+        crawl, at most 'concurrency' of them at a time. The random pause of 'rand_time' after every page is taken while
+        holding a place, so it limits the throughput of the lookup. An ASIN answered with a 4xx status such as a 404 fails
+        at once, other failures are retried up to 'max_retries' times.
+
+        Args:
+            - asins (list): The ASINs to look up. Surrounding spaces and case are ignored, and inputs naming the same
+              ASIN are looked up once.
+            - concurrency (int): The maximum number of products scraped at the same time.
+            - max_retries (int): The maximum number of attempts per product.
+
+        Returns:
+            - tuple: The records, and the error messages of the ASINs that couldn't be scraped, both keyed by the inputs
+              exactly as given in 'asins'.
+        """
+        records, errors = {}, {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        # The inputs naming every ASIN, so the results are returned under the keys the caller passed:
+        inputs = {}
+        for key in asins:
+            inputs.setdefault(key.strip().upper(), []).append(key)
+
+        def report(results, asin, value):
+            for key in inputs[asin]:
+                results[key] = value
+
+        async def scrape(asin):
+            async with semaphore:
+                try:
+                    result = await self.product_stage(f"{self.origin}/dp/{asin}", max_retries, FINAL_STATUSES)
+                    report(records, asin, result[0])
+                except PageError as e:
+                    report(errors, asin, str(e) if e.cause in [f"http_{status}" for status in FINAL_STATUSES] else f"No valid page after {e.attempts} attempts, last cause: {e.cause}.")
+                except Exception as e:
+                    report(errors, asin, str(e))
+
+        valid = []
+        for asin in inputs:
+            if re.fullmatch(r'[A-Z0-9]{10}', asin):
+                valid.append(asin)
+            else:
+                report(errors, asin, "Not a valid ASIN.")
+
+        metrics.inc('amazon_queue_depth', len(valid), domain = host(self.base_url), stage = 'product')
+        for asin in valid:
+            tracer.queue(f"{self.origin}/dp/{asin}")
+        await asyncio.gather(*[self.queued('product', scrape(asin)) for asin in valid])
+        # Write the trace events of the looked up pages, there is no export to hold them for:
+        tracer.sink('lookup')
+        return records, errors
+
+
+    async def queued(self, stage, coroutine):
+        """
+        Awaits a scheduled page coroutine and takes it off the queue depth gauge of its stage once it finishes.
+
+        Args:
+            - stage (str): The crawl stage of the page, "search" or "product".
+            - coroutine: The coroutine scraping the page.
+
+        Returns:
+            - The result of the coroutine.
+        """
+        try:
+            return await coroutine
+        finally:
+            metrics.dec('amazon_queue_depth', domain = host(self.base_url), stage = stage)
+
+
     async def crawl_url(self):
         """
         Crawls through multiple pages and retrieves a list of product URLs.
@@ -331,7 +516,10 @@ class Amazon:
             - list: A list of product URLs.
         """
         page_lists = await self.split_url()
-        coroutines = [self.product_urls(url) for url in page_lists]
+        metrics.inc('amazon_queue_depth', len(page_lists), domain = host(self.base_url), stage = 'search')
+        for url in page_lists:
+            tracer.queue(url)
+        coroutines = [self.queued('search', self.product_urls(url)) for url in page_lists]
         results = await asyncio.gather(*coroutines)
         return flat(results)
 
@@ -351,7 +539,10 @@ class Amazon:
         product_urls = await self.crawl_url()
 
         # Use coroutines to scrape and save data from each URL concurrently:
-        coroutines = [self.scrape_product_info(url) for url in product_urls]
+        metrics.inc('amazon_queue_depth', len(product_urls), domain = host(self.base_url), stage = 'product')
+        for url in product_urls:
+            tracer.queue(url)
+        coroutines = [self.queued('product', self.product_stage(url)) for url in product_urls]
         results = await asyncio.gather(*coroutines)
         return results
 
@@ -384,6 +575,9 @@ class Amazon:
 
         categ_name = f"{self.region} - {searches}."
         concurrency_results = await self.concurrency()
+
+        # Imported here so that runs which don't export a CSV don't pay for loading pandas:
+        import pandas as pd
         results_dataframes = [pd.DataFrame(result) for result in concurrency_results]
 
         # Concatenate the DataFrames obtained from each URL:
@@ -391,4 +585,35 @@ class Amazon:
 
         # Export the concatenated DataFrame to a CSV file:
         await export_sheet(final_results, categ_name)
+        metrics.inc('amazon_records_exported_total', len(final_results), domain = host(self.base_url), sink = 'csv')
+        tracer.sink('csv')
+
+        # Append what changed since the previous export of the category to its change feed:
+        changes.emit(categ_name, flat(concurrency_results), host(self.base_url))
 
+        # Keep the latest state and the price history of the products in the local store:
+        store.write(flat(concurrency_results), searches, host(self.base_url))
+
+
+async def lookup_asins(asins, region = 'USA', proxy = None, concurrency = 50, max_retries = 3, rand_time = 0):
+    """
+    Looks a batch of ASINs up on the Amazon site of a region.
+
+    Args:
+        - asins (list): The ASINs to look up.
+        - region (str): The region, as a country name ("USA", "UK", ...) or a domain suffix ("com", "co.uk", ...).
+        - proxy (str): The proxy to be used for making requests.
+        - concurrency (int): The maximum number of products scraped at the same time.
+        - max_retries (int): The maximum number of attempts per product.
+        - rand_time (int): The maximum random pause in seconds after every product page. Lookups don't pause by
+          default, None keeps the crawl's polite pause of up to 2 minutes, which caps a lookup at about 'concurrency'
+          ASINs per minute.
+
+    Returns:
+        - tuple: The records, and the error messages of the ASINs that couldn't be scraped, both keyed by the inputs
+          exactly as given in 'asins'.
+    """
+    amazon = Amazon(region_origin(region), proxy)
+    if rand_time is not None:
+        amazon.rand_time = rand_time
+    return await amazon.lookup(asins, concurrency, max_retries)
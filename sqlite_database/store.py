@@ -0,0 +1,242 @@
+from tools.metrics import metrics
+import argparse
+import sqlite3
+import json
+import time
+import re
+import os
+
+
+def to_number(text):
+    """
+    Converts a scraped price or count such as "1,299.00" or "1.299,00" to a float.
+
+    Args:
+        -text: The scraped value, "N/A" or None when it was missing.
+
+    Returns:
+        -float: The number, or None if the value isn't a number.
+    """
+    if isinstance(text, (int, float)):
+        return float(text)
+    if not isinstance(text, str):
+        return None
+    value = re.sub(r'[^\d.,]', '', text)
+    # The separator found last is the decimal one, unless a lone comma is followed by three digits:
+    if ',' in value and (value.rfind(',') > value.rfind('.')) and not re.fullmatch(r'\d{1,3}(,\d{3})+', value):
+        value = value.replace('.', '').replace(',', '.')
+    else:
+        value = value.replace(',', '')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class ProductStore:
+    """
+    An embedded SQLite store of scraped products that works without any database server.
+
+    "products" holds the latest state of every product, one row per ASIN and region. "history" is append-only and
+    receives a row whenever the price, deal price or availability of a product differs from its latest state, so the
+    price history of a product is the list of its history rows. Both tables are indexed on ASIN, region and time.
+
+    The store is closed until 'open' is called, and 'write' does nothing while it is closed.
+    """
+
+
+    def __init__(self):
+        self.db = None
+
+
+    @property
+    def enabled(self):
+        return self.db is not None
+
+
+    def open(self, path):
+        """
+        Opens or creates the store.
+
+        Args:
+            -path (str): The SQLite file of the store.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS products (
+                asin TEXT NOT NULL,
+                region TEXT NOT NULL,
+                category TEXT,
+                name TEXT,
+                price REAL,
+                deal_price REAL,
+                rating REAL,
+                rating_count REAL,
+                availability TEXT,
+                store TEXT,
+                hyperlink TEXT,
+                record TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (asin, region)
+            );
+            CREATE INDEX IF NOT EXISTS products_category ON products (category, region);
+            CREATE TABLE IF NOT EXISTS history (
+                asin TEXT NOT NULL,
+                region TEXT NOT NULL,
+                scraped_at REAL NOT NULL,
+                price REAL,
+                deal_price REAL,
+                availability TEXT
+            );
+            CREATE INDEX IF NOT EXISTS history_asin ON history (asin, region, scraped_at);
+            CREATE INDEX IF NOT EXISTS history_time ON history (scraped_at);
+        """)
+        return self
+
+
+    def write(self, records, category = None, domain = ''):
+        """
+        Upserts scraped records into the latest state and appends the price and availability changes to the history.
+
+        Args:
+            -records (list): The product records returned by 'scrape_product_info'.
+            -category (str): The category the records were scraped from.
+            -domain (str): The Amazon host the records come from, used to label the metrics.
+
+        Returns:
+            -int: The number of history rows appended.
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        appended = 0
+        with self.db:
+            for record in records:
+                key = (record['ASIN'], record['Region'])
+                price, deal_price, availability = to_number(record.get('Price')), to_number(record.get('Deal Price')), record.get('Availability')
+                latest = self.db.execute("SELECT price, deal_price, availability FROM products WHERE asin = ? AND region = ?", key).fetchone()
+                if latest is None or tuple(latest) != (price, deal_price, availability):
+                    self.db.execute("INSERT INTO history (asin, region, scraped_at, price, deal_price, availability) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (*key, now, price, deal_price, availability))
+                    appended += 1
+                self.db.execute("""
+                    INSERT INTO products (asin, region, category, name, price, deal_price, rating, rating_count, availability, store,
+                                          hyperlink, record, first_seen, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (asin, region) DO UPDATE SET
+                        category = COALESCE(excluded.category, category), name = excluded.name, price = excluded.price,
+                        deal_price = excluded.deal_price, rating = excluded.rating, rating_count = excluded.rating_count,
+                        availability = excluded.availability, store = excluded.store, hyperlink = excluded.hyperlink,
+                        record = excluded.record, updated_at = excluded.updated_at
+                """, (*key, category, record.get('Name'), price, deal_price, to_number(record.get('Rating')), to_number(record.get('Rating count')),
+                      availability, record.get('Store'), record.get('Hyperlink'),
+                      json.dumps({field: value for field, value in record.items() if field != '_id'}, default = str), now, now))
+        metrics.inc('amazon_records_exported_total', len(records), domain = domain, sink = 'sqlite')
+        return appended
+
+
+    def product(self, asin, region = None):
+        """
+        Looks a product up by ASIN.
+
+        Args:
+            -asin (str): The ASIN of the product.
+            -region (str): The region to look in, e.g. "USA", or None for every region.
+
+        Returns:
+            -list: The latest state of the product in each region, as dictionaries holding the full scraped record.
+        """
+        if region is None:
+            rows = self.db.execute("SELECT * FROM products WHERE asin = ?", (asin,)).fetchall()
+        else:
+            rows = self.db.execute("SELECT * FROM products WHERE asin = ? AND region = ?", (asin, region)).fetchall()
+        return [{**dict(row), 'record': json.loads(row['record'])} for row in rows]
+
+
+    def price_history(self, asin, region = None, since = None):
+        """
+        Returns the price and availability changes of a product, oldest first.
+
+        Args:
+            -asin (str): The ASIN of the product.
+            -region (str): The region to look in, or None for every region.
+            -since (float): Only return changes after this epoch timestamp.
+
+        Returns:
+            -list: The history rows as dictionaries.
+        """
+        query, params = "SELECT * FROM history WHERE asin = ?", [asin]
+        if region is not None:
+            query, params = query + " AND region = ?", params + [region]
+        if since is not None:
+            query, params = query + " AND scraped_at > ?", params + [since]
+        return [dict(row) for row in self.db.execute(query + " ORDER BY scraped_at", params).fetchall()]
+
+
+    def category_summary(self, category = None, region = None):
+        """
+        Aggregates the latest state of the products per category and region.
+
+        Args:
+            -category (str): Only summarize this category.
+            -region (str): Only summarize this region.
+
+        Returns:
+            -list: One dictionary per category and region with the number of products, the minimum, average and maximum
+             price, the average rating and the time of the last update.
+        """
+        query, params = """
+            SELECT category, region, COUNT(*) AS products, MIN(price) AS min_price, ROUND(AVG(price), 2) AS avg_price,
+                   MAX(price) AS max_price, ROUND(AVG(rating), 2) AS avg_rating, MAX(updated_at) AS updated_at
+            FROM products WHERE 1 = 1
+        """, []
+        if category is not None:
+            query, params = query + " AND category = ?", params + [category]
+        if region is not None:
+            query, params = query + " AND region = ?", params + [region]
+        return [dict(row) for row in self.db.execute(query + " GROUP BY category, region ORDER BY category, region", params).fetchall()]
+
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.db.close()
+        self.db = None
+
+
+store = ProductStore()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Query the local product store.")
+    parser.add_argument('--db', default = os.path.join('Amazon database', 'products.sqlite'), help = "The SQLite file of the store.")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    command = commands.add_parser('asin', help = "Show the latest state of a product.")
+    command.add_argument('asin')
+    command.add_argument('--region')
+    command = commands.add_parser('history', help = "Show the price and availability changes of a product.")
+    command.add_argument('asin')
+    command.add_argument('--region')
+    command = commands.add_parser('categories', help = "Show price and rating aggregates per category.")
+    command.add_argument('--category')
+    command.add_argument('--region')
+    args = parser.parse_args()
+
+    store.open(args.db)
+    start = time.perf_counter()
+    if args.command == 'asin':
+        results = store.product(args.asin, args.region)
+    elif args.command == 'history':
+        results = store.price_history(args.asin, args.region)
+    else:
+        results = store.category_summary(args.category, args.region)
+    elapsed = time.perf_counter() - start
+    for result in results:
+        print(json.dumps(result, default = str))
+    print(f"{len(results)} rows in {round(elapsed * 1000, 2)} ms.")
+    store.close()
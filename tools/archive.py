@@ -0,0 +1,312 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse
+import argparse
+import asyncio
+import json
+import time
+import os
+import re
+
+
+# Pack files are rotated once they grow past this size:
+PACK_SIZE = 256 * 1024 * 1024
+
+# Number of appended pages between two commits of the index:
+COMMIT_EVERY = 100
+
+
+def page_asin(url):
+    """
+    Extracts the ASIN from a product URL, or returns "N/A" for any other page.
+    """
+    asin = re.search(r"(?<=dp\/)[A-Za-z|0-9]+", url)
+    return asin.group(0) if asin else "N/A"
+
+
+class Archive:
+    """
+    An append-only archive of raw fetched pages.
+
+    Pages are compressed one by one into zstd frames and appended to numbered pack files ("pack-00001.zst", ...). Every
+    frame starts with a JSON header line holding the URL, status and fetch time of the page, so the packs describe
+    themselves. A SQLite index maps URLs and ASINs to the pack, offset and length of their frames.
+
+    The archive is closed until 'open' is called, and 'append' does nothing while it is closed.
+    """
+
+
+    def __init__(self):
+        self.root = None
+        self.index = None
+        self.pack = None
+        self.pack_name = None
+        self.compressor = None
+        self.uncommitted = 0
+
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+
+    def open(self, root, level = 3):
+        """
+        Opens or creates an archive directory.
+
+        Args:
+            -root (str): The directory holding the pack files and the index.
+            -level (int): The zstd compression level used for new pages.
+        """
+        # Loaded once an archive is opened, so that importing the fetch layer doesn't pay for them:
+        import zstandard
+        import sqlite3
+
+        os.makedirs(root, exist_ok = True)
+        self.root = root
+        self.compressor = zstandard.ZstdCompressor(level = level)
+        self.index = sqlite3.connect(os.path.join(root, 'index.sqlite'))
+        self.index.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                asin TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                status INTEGER,
+                robot_check INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                pack TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_url ON pages (url);
+            CREATE INDEX IF NOT EXISTS pages_asin ON pages (asin, domain);
+        """)
+        packs = sorted(name for name in os.listdir(root) if name.startswith('pack-'))
+        self.open_pack(packs[-1] if packs else 'pack-00001.zst')
+        return self
+
+
+    def open_pack(self, name):
+        if self.pack is not None:
+            self.pack.close()
+        self.pack_name = name
+        self.pack = open(os.path.join(self.root, name), 'ab')
+
+
+    def append(self, url, content, status = None, robot_check = False):
+        """
+        Compresses a fetched page and appends it to the current pack file.
+
+        Args:
+            -url (str): The URL the page was fetched from.
+            -content (bytes): The raw page.
+            -status (int): The HTTP status of the response.
+            -robot_check (bool): Whether Amazon answered with its robot check page.
+        """
+        if not self.enabled:
+            return
+        if self.pack.tell() >= PACK_SIZE:
+            number = int(self.pack_name[5:10]) + 1
+            self.open_pack(f"pack-{number:05d}.zst")
+
+        fetched_at = time.time()
+        header = json.dumps({'url': url, 'status': status, 'fetched_at': fetched_at}).encode()
+        frame = self.compressor.compress(header + b'\n' + content)
+        offset = self.pack.tell()
+        self.pack.write(frame)
+        self.index.execute("INSERT INTO pages (url, asin, domain, status, robot_check, fetched_at, pack, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (url, page_asin(url), urlparse(url).hostname or '', status, int(robot_check), fetched_at, self.pack_name, offset, len(frame)))
+
+        # Commit in batches, flushing the pack first so the index never points past the data on disk:
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+
+    def commit(self):
+        self.pack.flush()
+        self.index.commit()
+        self.uncommitted = 0
+
+
+    def find(self, url = None, asin = None):
+        """
+        Looks pages up in the index.
+
+        Args:
+            -url (str): Return the pages fetched from this URL.
+            -asin (str): Return the pages of this ASIN.
+
+        Returns:
+            -list: The matching index rows as dictionaries, oldest first.
+        """
+        query, params = "SELECT * FROM pages", ()
+        if url is not None:
+            query, params = "SELECT * FROM pages WHERE url = ?", (url,)
+        elif asin is not None:
+            query, params = "SELECT * FROM pages WHERE asin = ?", (asin,)
+        cursor = self.index.execute(query + " ORDER BY id", params)
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+    def load(self, row):
+        """
+        Reads a page back from the archive.
+
+        Args:
+            -row (dict): An index row returned by 'find'.
+
+        Returns:
+            -bytes: The raw page.
+        """
+        self.commit()
+        return read_frame(self.root, row['pack'], row['offset'], row['length'])[1]
+
+
+    def close(self):
+        """
+        Commits the index and closes the archive.
+        """
+        if not self.enabled:
+            return
+        self.commit()
+        self.pack.close()
+        self.index.close()
+        self.root = self.index = self.pack = None
+
+
+archive = Archive()
+
+
+def read_frame(root, pack, offset, length, file = None):
+    """
+    Reads and decompresses one archived page.
+
+    Returns:
+        -tuple: The header of the frame as a dictionary and the raw page.
+    """
+    if file is None:
+        with open(os.path.join(root, pack), 'rb') as file:
+            return read_frame(root, pack, offset, length, file)
+    import zstandard
+
+    file.seek(offset)
+    header, content = zstandard.ZstdDecompressor().decompress(file.read(length)).split(b'\n', 1)
+    return json.loads(header), content
+
+
+# Scrapers of the worker process, one per Amazon host:
+_scrapers = {}
+
+
+async def extract_rows(root, pack, rows):
+    """
+    Reruns the product extractor over archived pages of one pack file.
+
+    Returns:
+        -tuple: The extracted records and a list of (url, error) pairs.
+    """
+    # Imported here so that writing to the archive doesn't depend on the scraper module:
+    from scrapers.scraper import Amazon
+
+    records, errors = [], []
+    with open(os.path.join(root, pack), 'rb') as file:
+        for url, offset, length in rows:
+            origin = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
+            if origin not in _scrapers:
+                _scrapers[origin] = Amazon(origin, None)
+                # Every worker must extract the same values from the same page, whatever pages it saw before:
+                _scrapers[origin].fallbacks.skip_unmatched = False
+            try:
+                _, content = read_frame(root, pack, offset, length, file)
+                records.append(await _scrapers[origin].extract_product(content, url))
+            except Exception as e:
+                errors.append((url, str(e)))
+    return records, errors
+
+
+def extract_chunk(root, pack, rows):
+    return asyncio.run(extract_rows(root, pack, rows))
+
+
+def reextract(root, output, workers = None, chunk_size = 500):
+    """
+    Reruns the current product extractors over the latest archived page of every product, on all cores.
+
+    Nothing is fetched from the network. Robot check pages and non-200 responses are skipped.
+
+    Args:
+        -root (str): The archive directory.
+        -output (str): The CSV file to write the records to.
+        -workers (int): The number of worker processes, all cores by default.
+        -chunk_size (int): The number of pages handed to a worker at a time.
+
+    Returns:
+        -pandas.DataFrame: The re-extracted records.
+    """
+    import sqlite3
+
+    index = sqlite3.connect(os.path.join(root, 'index.sqlite'))
+    rows = index.execute("""
+        SELECT url, pack, offset, length FROM pages WHERE id IN (
+            SELECT MAX(id) FROM pages WHERE asin != 'N/A' AND status = 200 AND robot_check = 0 GROUP BY domain, asin
+        ) ORDER BY pack, offset
+    """).fetchall()
+    index.close()
+
+    # Split the pages into chunks that each read a single pack file sequentially:
+    chunks = []
+    for url, pack, offset, length in rows:
+        if not chunks or chunks[-1][0] != pack or len(chunks[-1][1]) >= chunk_size:
+            chunks.append((pack, []))
+        chunks[-1][1].append((url, offset, length))
+
+    start = time.time()
+    records, errors = [], []
+    with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as pool:
+        futures = [pool.submit(extract_chunk, root, pack, chunk) for pack, chunk in chunks]
+        for future in as_completed(futures):
+            chunk_records, chunk_errors = future.result()
+            records.extend(chunk_records)
+            errors.extend(chunk_errors)
+
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    df.to_csv(output, index = False)
+    print(f"Re-extracted {len(records)} products from {len(rows)} archived pages in {round(time.time() - start, 2)} seconds, {len(errors)} failed. Saved to {output}.")
+    for url, error in errors[:10]:
+        print(f"Failed: {url} || {error}")
+    return df
+
+
+def stats(root):
+    """
+    Prints the number of archived pages and the size of the archive.
+    """
+    import sqlite3
+
+    index = sqlite3.connect(os.path.join(root, 'index.sqlite'))
+    pages, products, blocked = index.execute("SELECT COUNT(*), COUNT(DISTINCT domain || asin), SUM(robot_check) FROM pages").fetchone()
+    index.close()
+    size = sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root) if name.startswith('pack-'))
+    print(f"{pages} pages, {products} distinct ASINs, {blocked or 0} robot checks, {round(size / 1024 / 1024, 2)} MB of packs.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Inspect the raw page archive or re-extract products from it.")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    command = commands.add_parser('reextract', help = "Rerun the current extractors over the archive, without network access.")
+    command.add_argument('root', help = "The archive directory.")
+    command.add_argument('--output', default = 'reextracted.csv', help = "The CSV file to write the records to.")
+    command.add_argument('--workers', type = int, default = None, help = "Number of worker processes, all cores by default.")
+    command = commands.add_parser('stats', help = "Show the size of the archive.")
+    command.add_argument('root', help = "The archive directory.")
+    args = parser.parse_args()
+
+    if args.command == 'reextract':
+        reextract(args.root, args.output, args.workers)
+    else:
+        stats(args.root)
@@ -0,0 +1,124 @@
+from tools.metrics import metrics
+import hashlib
+import json
+import time
+import os
+
+
+# Fields left out of the comparison. The search parameters in product links change on every run, and the image files
+# describe the local image store rather than the product, whose image changes show in "Image" and "Images":
+IGNORED_FIELDS = ('Hyperlink', 'Image file', 'Thumbnail', 'Image files')
+
+
+def digest(value):
+    """
+    Returns a short stable hash of a JSON serializable value.
+    """
+    return hashlib.blake2b(json.dumps(value, sort_keys = True, default = str).encode(), digest_size = 8).hexdigest()
+
+
+def fingerprint(record):
+    """
+    Hashes every compared field of a record.
+
+    Returns:
+        -dict: The hash of every field, by field name.
+    """
+    return {field: digest(value) for field, value in record.items() if field not in IGNORED_FIELDS and field != '_id'}
+
+
+class ChangeFeed:
+    """
+    Compares every exported snapshot with the previous one and appends only the differences to a JSONL change feed.
+
+    For each snapshot name (a category of a region) a compact state file keeps a hash of every field of every ASIN of
+    the last run, and "<name>.jsonl" receives one line per new, removed or modified product. Modified lines name the
+    fields that changed and carry their new values, new lines carry the whole record. The first run of a snapshot
+    reports every product as new.
+
+    The feed is closed until 'open' is called.
+    """
+
+
+    def __init__(self):
+        self.root = None
+
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+
+    def open(self, root):
+        """
+        Opens or creates the directory holding the state files and the change feeds.
+
+        Args:
+            -root (str): The directory to use.
+        """
+        os.makedirs(os.path.join(root, 'state'), exist_ok = True)
+        self.root = root
+        return self
+
+
+    def emit(self, name, records, domain = ''):
+        """
+        Diffs a snapshot against the previous one of the same name and appends the changes to its feed.
+
+        Args:
+            -name (str): The name of the snapshot, e.g. the region and category of the export.
+            -records (list): The product records of the new snapshot.
+            -domain (str): The Amazon host the records come from, used to label the metrics.
+
+        Returns:
+            -dict: The number of new, removed, modified and unchanged products.
+        """
+        if not self.enabled:
+            return {}
+        state_path = os.path.join(self.root, 'state', f"{name}.json")
+        previous = {}
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                previous = json.load(file)
+
+        run = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        current = {}
+        changes = []
+        counts = {'new': 0, 'removed': 0, 'modified': 0, 'unchanged': 0}
+        for record in records:
+            # A product listed on several result pages is scraped once per listing, keep the first:
+            if record['ASIN'] in current:
+                continue
+            fields = fingerprint(record)
+            current[record['ASIN']] = fields
+            old = previous.get(record['ASIN'])
+            if old is None:
+                changes.append({'op': 'new', 'run': run, 'asin': record['ASIN'],
+                                'record': {field: value for field, value in record.items() if field != '_id'}})
+                continue
+            changed = sorted(field for field in fields.keys() | old.keys() if fields.get(field) != old.get(field))
+            if changed:
+                changes.append({'op': 'modified', 'run': run, 'asin': record['ASIN'], 'changed': changed,
+                                'values': {field: record.get(field) for field in changed}})
+            else:
+                counts['unchanged'] += 1
+        for asin in previous.keys() - current.keys():
+            changes.append({'op': 'removed', 'run': run, 'asin': asin})
+
+        with open(os.path.join(self.root, f"{name}.jsonl"), 'a') as file:
+            for change in changes:
+                counts[change['op']] += 1
+                file.write(json.dumps(change, default = str) + '\n')
+
+        # Replace the state only once the feed is written, so a crash can't lose changes:
+        with open(f"{state_path}.tmp", 'w') as file:
+            json.dump(current, file, separators = (',', ':'))
+        os.replace(f"{state_path}.tmp", state_path)
+
+        for op in ('new', 'removed', 'modified'):
+            metrics.inc('amazon_changes_total', counts[op], domain = domain, op = op)
+        print(f"{name} changes || new: {counts['new']} | modified: {counts['modified']} | removed: {counts['removed']} | unchanged: {counts['unchanged']}.")
+        return counts
+
+
+changes = ChangeFeed()
@@ -0,0 +1,94 @@
+from tools.metrics import metrics
+
+
+# Lookups of every field and hits of every selector alternative, per (host, field), shared by all scrapers of the process:
+_lookups = {}
+_hits = {}
+
+# Number of lookups of a field after which the alternatives that never matched on a host are tried last:
+UNMATCHED_AFTER = 50
+
+
+class Fallbacks:
+    """
+    Finds page elements through the fallback chains of CSS selectors declared in selector.yaml.
+
+    A field of the YAML file is either a single selector, a list of alternatives tried in order, or a mapping holding a
+    "default" list and lists for specific regions ("UK", "India", ...) that are used instead of it. The declared order
+    is a priority, as a chain can end with a general selector that also matches pages the specific ones are meant for.
+    Every hit is counted per Amazon host, and once a field was looked up 'UNMATCHED_AFTER' times on a host, the
+    alternatives that never matched there are tried after the others instead of costing a tree search on every page.
+
+    Args:
+        - scrape (dict): The selectors loaded with 'yaml_load'.
+        - region (str): The region of the scraped domain, as returned by 'region'.
+        - domain (str): The host name the hits are counted for.
+
+    Attributes:
+        - skip_unmatched (bool): Whether alternatives that never matched are tried last. Turned off where every process
+          must extract the same values from the same page, like the archive re-extraction workers.
+    """
+
+
+    def __init__(self, scrape, region, domain):
+        self.scrape = scrape
+        self.region = region
+        self.domain = domain
+        self.skip_unmatched = True
+
+
+    def alternatives(self, field):
+        """
+        Returns the selectors declared for a field in the region of the scraper, in the order of the YAML file.
+        """
+        selectors = self.scrape[field]
+        if isinstance(selectors, dict):
+            selectors = selectors.get(self.region, selectors['default'])
+        return [selectors] if isinstance(selectors, str) else list(selectors)
+
+
+    def ordered(self, field):
+        """
+        Returns the selectors of a field in the order they are tried.
+        """
+        key = (self.domain, field)
+        alternatives = self.alternatives(field)
+        if key not in _hits:
+            _hits[key] = dict.fromkeys(alternatives, 0)
+            _lookups[key] = 0
+        if not self.skip_unmatched or _lookups[key] < UNMATCHED_AFTER:
+            return alternatives
+        hits = _hits[key]
+        return [selector for selector in alternatives if hits[selector]] + [selector for selector in alternatives if not hits[selector]]
+
+
+    def hit(self, field, selector):
+        """
+        Counts a hit of a selector.
+        """
+        _hits[(self.domain, field)][selector] += 1
+        metrics.inc('amazon_selector_hits_total', domain = self.domain, field = field,
+                    alternative = str(self.alternatives(field).index(selector)))
+
+
+    def select_one(self, soup, field, accept = None):
+        """
+        Returns the first element matched by the alternatives of a field.
+
+        Args:
+            -soup (BeautifulSoup): The parsed page.
+            -field (str): The name of the field in selector.yaml.
+            -accept (callable): An optional check of the matched element, alternatives whose element fails it are skipped.
+
+        Returns:
+            -The matched element, or None if no alternative matched.
+        """
+        alternatives = self.ordered(field)
+        _lookups[(self.domain, field)] += 1
+        for selector in alternatives:
+            element = soup.select_one(selector)
+            if element is not None and (accept is None or accept(element)):
+                self.hit(field, selector)
+                return element
+        return None
+
@@ -0,0 +1,209 @@
+from tools.metrics import metrics
+from tools.trace import tracer
+import collections
+import asyncio
+import time
+
+
+# Seconds after which a request is abandoned, until 'set_timeout' changes it:
+DEFAULT_TIMEOUT = 30
+
+
+class HedgedRequests:
+    """
+    Bounds the time of every request and duplicates the slow ones through another proxy.
+
+    An attempt that hasn't received its page after 'timeout' seconds, 'DEFAULT_TIMEOUT' unless 'set_timeout' changes
+    it, raises asyncio.TimeoutError and is retried like any other failed request. The timeout applies whether hedging is
+    on or not.
+
+    With hedging on, the latencies of the last 'window' answered requests of every host give its hedging deadline, the
+    'percentile' of those latencies. Latencies and deadlines are counted from the moment a request is sent, after it got
+    its concurrency slot, so requests only waiting in the local queue are neither duplicated nor slow down the deadline.
+    A request still unanswered at the deadline is sent again through another proxy and
+    the first good response of the two wins, the other request is cancelled. A slow proxy then costs a page the deadline
+    plus one normal request instead of its whole hang. Duplicates are capped at 'budget' times the number of requests,
+    so at most 5% more requests are sent by default. A host gets no duplicates until 'warmup' of its requests were
+    answered. The deadline of every host is exposed as the "amazon_hedge_deadline_seconds" gauge and the duplicates as
+    "amazon_hedged_requests_total", by outcome.
+
+    Hedging is off until 'enable' is called, and requests are then sent once.
+    """
+
+
+    def __init__(self):
+        self.enabled = False
+        self.timeout = DEFAULT_TIMEOUT
+        self.latencies = {}
+        self.requests = 0
+        self.hedges = 0
+
+
+    def set_timeout(self, seconds):
+        """
+        Sets the maximum time of a request.
+
+        Args:
+            -seconds (float): The time after which a request is abandoned, or None to wait as long as the connection stays open.
+        """
+        self.timeout = seconds
+
+
+    def enable(self, proxies = None, percentile = 95, budget = 0.05, window = 200, warmup = 20, minimum_delay = 0.25):
+        """
+        Turns hedging on.
+
+        Args:
+            -proxies (callable): Returns a proxy URL to send a duplicate through, e.g. a random one of "tools/proxies.txt".
+             Duplicates go through the proxy of the request when None.
+            -percentile (float): The percentile of the recent latencies of a host after which a request is duplicated.
+            -budget (float): The highest ratio of duplicates to requests.
+            -window (int): The number of recent latencies the deadline is computed over, per host.
+            -warmup (int): The number of latencies a host needs before its requests are duplicated.
+            -minimum_delay (float): The shortest deadline in seconds, so fast hosts aren't sent every request twice.
+        """
+        self.enabled = True
+        self.proxies = proxies
+        self.percentile, self.budget = percentile, budget
+        self.window, self.warmup, self.minimum_delay = window, warmup, minimum_delay
+        self.latencies = {}
+        self.requests = self.hedges = 0
+
+
+    async def limit(self, coroutine):
+        """
+        Awaits a request, abandoning it after the timeout.
+        """
+        if self.timeout is None:
+            return await coroutine
+        try:
+            return await asyncio.wait_for(coroutine, self.timeout)
+        except asyncio.TimeoutError as e:
+            raise asyncio.TimeoutError(str(e) or f"No response within {self.timeout} seconds.") from e
+
+
+    def deadline(self, domain):
+        """
+        Returns the time in seconds after which a request to the host is duplicated, or None while it is warming up.
+        """
+        latencies = self.latencies.get(domain)
+        if latencies is None or len(latencies) < self.warmup:
+            return None
+        ordered = sorted(latencies)
+        value = ordered[min(max(int(round(self.percentile / 100 * len(ordered))) - 1, 0), len(ordered) - 1)]
+        delay = max(value, self.minimum_delay)
+        metrics.set('amazon_hedge_deadline_seconds', round(delay, 3), domain = domain)
+        return delay
+
+
+    def observe(self, domain, seconds):
+        if domain not in self.latencies:
+            self.latencies[domain] = collections.deque(maxlen = self.window)
+        self.latencies[domain].append(seconds)
+
+
+    def alternative(self, proxy):
+        """
+        Picks the proxy of a duplicate, a different one than the request's whenever the proxy source allows it.
+        """
+        if self.proxies is None:
+            return proxy
+        for _ in range(5):
+            candidate = self.proxies()
+            if candidate != proxy:
+                return candidate
+        return proxy
+
+
+    async def run(self, domain, proxy, attempt, accept):
+        """
+        Sends a request, and a duplicate through another proxy if it is still unanswered at the deadline of its host.
+
+        Args:
+            -domain (str): The host the request is sent to.
+            -proxy (str): The proxy of the request, or None for a direct connection.
+            -attempt (callable): Sends the request through the proxy it is given and returns its result. It is also given a
+             callback to call once the request leaves the local queue and is actually sent.
+            -accept (callable): Returns whether a result is a good response, e.g. not a 503 or a robot check page.
+
+        Returns:
+            -tuple: The result of the winning request, or of the first one if none was good, and the proxy it went through.
+
+        Raises:
+            -The exception of the first request if every request failed.
+        """
+        if not self.enabled:
+            return await attempt(proxy, lambda: None), proxy
+        self.requests += 1
+        # The moment every request was sent, by name:
+        sent = {}
+        primary_sent = asyncio.Event()
+
+        def sender(name, event = None):
+            def mark():
+                sent[name] = time.perf_counter()
+                if event is not None:
+                    event.set()
+            return mark
+
+        primary = asyncio.ensure_future(attempt(proxy, sender('primary', primary_sent)))
+        tasks = {primary: proxy}
+        names = {primary: 'primary'}
+        winner = None
+        try:
+            delay = self.deadline(domain)
+            if delay is not None:
+                # Start the deadline once the request got its concurrency slot and went out:
+                waiter = asyncio.ensure_future(primary_sent.wait())
+                await asyncio.wait([primary, waiter], return_when = asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not primary.done():
+                    await asyncio.wait([primary], timeout = delay)
+                if not primary.done() and self.hedges + 1 > self.budget * self.requests:
+                    metrics.inc('amazon_hedged_requests_total', domain = domain, outcome = 'over_budget')
+                elif not primary.done():
+                    self.hedges += 1
+                    tracer.mark('hedge_start')
+                    alternative = self.alternative(proxy)
+                    duplicate = asyncio.ensure_future(self.detached(attempt(alternative, sender('duplicate'))))
+                    tasks[duplicate] = alternative
+                    names[duplicate] = 'duplicate'
+
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                # Prefer the request itself when both finished together:
+                for task in sorted(done, key = lambda task: task is not primary):
+                    if task.exception() is None and accept(task.result()):
+                        winner = task
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the loser release its concurrency slot and connection before going on:
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+        if len(tasks) > 1:
+            outcome = 'failed' if winner is None else 'lost' if winner is primary else 'won'
+            metrics.inc('amazon_hedged_requests_total', domain = domain, outcome = outcome)
+            tracer.mark('hedge_outcome', outcome)
+        if winner is not None:
+            # The latency of the winning request itself, from the moment it was sent:
+            if names[winner] in sent:
+                self.observe(domain, time.perf_counter() - sent[names[winner]])
+            return winner.result(), tasks[winner]
+        for task in tasks:
+            if task.exception() is None:
+                return task.result(), tasks[task]
+        raise primary.exception()
+
+
+    async def detached(self, coroutine):
+        """
+        Runs a duplicate request without recording its phases into the trace event of the page, the request it races does.
+        """
+        tracer.detach()
+        return await coroutine
+
+
+hedging = HedgedRequests()
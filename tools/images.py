@@ -0,0 +1,227 @@
+from concurrent.futures import ProcessPoolExecutor
+from tools.metrics import metrics, host
+from tools.tool import userAgents
+from urllib.parse import urlparse
+import hashlib
+import sqlite3
+import asyncio
+import aiohttp
+import time
+import os
+
+
+def make_thumbnail(source, target, size):
+    """
+    Writes a JPEG thumbnail of an image, run in the worker processes.
+
+    Returns:
+        -bool: False if the file couldn't be read as an image.
+    """
+    # Pillow is only needed by the worker processes:
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(source) as image:
+            image.thumbnail((size, size))
+            tmp = f"{target}.tmp"
+            image.convert('RGB').save(tmp, 'JPEG', quality = 85)
+        os.replace(tmp, target)
+        return True
+    except (UnidentifiedImageError, OSError):
+        return False
+
+
+class ImageStore:
+    """
+    Downloads the product images of scraped records into a content-addressed store.
+
+    Every image is saved once under "objects/<first 2 hex digits>/<sha256 of its content>" whatever the URL it came from,
+    with a thumbnail under "thumbnails/" generated in a process pool. A SQLite index maps every URL already downloaded to
+    its file, so URLs seen in this run or an earlier one are never downloaded again, and links every stored image to the
+    ASINs it belongs to.
+
+    Downloads use their own aiohttp session and concurrency limit, separate from the page requests. The store is closed
+    until 'open' is called.
+    """
+
+
+    def __init__(self):
+        self.root = None
+        self.index = None
+        self.session = None
+        self.pool = None
+        self.semaphore = None
+        # Downloads running in this process, by URL, so variants sharing an image wait for the same download:
+        self.downloads = {}
+
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+
+    def open(self, root, concurrency = 16, thumbnail_size = 160, workers = None):
+        """
+        Opens or creates an image store.
+
+        Args:
+            -root (str): The directory holding the images and the index.
+            -concurrency (int): The maximum number of images downloaded at the same time.
+            -thumbnail_size (int): The maximum width and height of the thumbnails, in pixels.
+            -workers (int): The number of thumbnail worker processes, all cores by default.
+        """
+        os.makedirs(root, exist_ok = True)
+        self.root = root
+        self.concurrency = concurrency
+        self.thumbnail_size = thumbnail_size
+        self.workers = workers
+        self.index = sqlite3.connect(os.path.join(root, 'index.sqlite'))
+        self.index.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS images (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                path TEXT NOT NULL,
+                thumbnail TEXT,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS product_images (
+                asin TEXT NOT NULL,
+                url TEXT NOT NULL,
+                PRIMARY KEY (asin, url)
+            );
+        """)
+        return self
+
+
+    def lookup(self, url):
+        """
+        Returns the stored file and thumbnail of an image URL, or None if it was never downloaded.
+        """
+        row = self.index.execute("SELECT path, thumbnail FROM images WHERE url = ?", (url,)).fetchone()
+        return row and (os.path.join(self.root, row[0]), row[1] and os.path.join(self.root, row[1]))
+
+
+    async def fetch(self, url, proxy = None):
+        """
+        Stores one image, downloading it only if its URL isn't in the store yet.
+
+        Args:
+            -url (str): The image URL.
+            -proxy (str): The proxy to download through, or None for a direct connection.
+
+        Returns:
+            -tuple: The paths of the stored image and its thumbnail, or None if the download failed.
+        """
+        if url in self.downloads:
+            metrics.inc('amazon_images_total', domain = host(url), outcome = 'duplicate_url')
+            return await asyncio.shield(self.downloads[url])
+        stored = self.lookup(url)
+        if stored:
+            metrics.inc('amazon_images_total', domain = host(url), outcome = 'duplicate_url')
+            return stored
+        self.downloads[url] = asyncio.ensure_future(self.download(url, proxy))
+        self.downloads[url].add_done_callback(lambda download: self.forget(url, download))
+        return await asyncio.shield(self.downloads[url])
+
+
+    def forget(self, url, download):
+        """
+        Drops a failed download, so the next product sharing the image downloads it again.
+        """
+        if download.cancelled() or download.exception() is not None or download.result() is None:
+            if self.downloads.get(url) is download:
+                del self.downloads[url]
+
+
+    async def download(self, url, proxy):
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = self.concurrency))
+
+        async with self.semaphore:
+            try:
+                async with self.session.get(url, headers = {'User-Agent': userAgents()}, proxy = proxy) as resp:
+                    if resp.status != 200:
+                        metrics.inc('amazon_images_total', domain = host(url), outcome = 'failed')
+                        return None
+                    body = await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.inc('amazon_images_total', domain = host(url), outcome = 'failed')
+                return None
+
+        # Name the file after its content, so the same image reached through different URLs is kept once:
+        digest = hashlib.sha256(body).hexdigest()
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or '.jpg'
+        path = os.path.join('objects', digest[:2], f"{digest}{extension}")
+        thumbnail = os.path.join('thumbnails', digest[:2], f"{digest}.jpg")
+        if os.path.exists(os.path.join(self.root, path)):
+            metrics.inc('amazon_images_total', domain = host(url), outcome = 'duplicate_content')
+        else:
+            os.makedirs(os.path.join(self.root, 'objects', digest[:2]), exist_ok = True)
+            os.makedirs(os.path.join(self.root, 'thumbnails', digest[:2]), exist_ok = True)
+            with open(os.path.join(self.root, f"{path}.tmp"), 'wb') as file:
+                file.write(body)
+            os.replace(os.path.join(self.root, f"{path}.tmp"), os.path.join(self.root, path))
+            metrics.inc('amazon_images_total', domain = host(url), outcome = 'downloaded')
+            metrics.inc('amazon_image_bytes_total', len(body), domain = host(url))
+
+        if not os.path.exists(os.path.join(self.root, thumbnail)):
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers = self.workers)
+            made = await asyncio.get_running_loop().run_in_executor(self.pool, make_thumbnail, os.path.join(self.root, path),
+                                                                    os.path.join(self.root, thumbnail), self.thumbnail_size)
+            thumbnail = thumbnail if made else None
+
+        self.index.execute("INSERT OR REPLACE INTO images (url, digest, path, thumbnail, size, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                           (url, digest, path, thumbnail, len(body), time.time()))
+        return os.path.join(self.root, path), thumbnail and os.path.join(self.root, thumbnail)
+
+
+    async def attach(self, record, proxy = None):
+        """
+        Stores the images of a scraped product and adds their files to the record.
+
+        Sets "Image file" and "Thumbnail" for the main image and "Image files" for the image list, and links every image
+        URL to the ASIN of the record in the index.
+
+        Args:
+            -record (dict): A product record returned by 'scrape_product_info'.
+            -proxy (str): The proxy to download through, or None for a direct connection.
+
+        Returns:
+            -dict: The record.
+        """
+        if not self.enabled:
+            return record
+        urls = [url for url in dict.fromkeys([record.get('Image'), *record.get('Images', [])]) if url and url.startswith('http')]
+        stored = dict(zip(urls, await asyncio.gather(*[self.fetch(url, proxy) for url in urls])))
+
+        main = stored.get(record.get('Image')) or (None, None)
+        record['Image file'], record['Thumbnail'] = main
+        record['Image files'] = [stored[url][0] for url in record.get('Images', []) if stored.get(url)]
+        self.index.executemany("INSERT OR IGNORE INTO product_images (asin, url) VALUES (?, ?)",
+                               [(record['ASIN'], url) for url in urls if stored[url]])
+        self.index.commit()
+        return record
+
+
+    async def close(self):
+        """
+        Waits for the running downloads, stops the thumbnail workers and closes the store.
+        """
+        if not self.enabled:
+            return
+        await asyncio.gather(*self.downloads.values(), return_exceptions = True)
+        if self.session is not None:
+            await self.session.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.index.commit()
+        self.index.close()
+        self.root = self.index = self.session = self.pool = self.semaphore = None
+        self.downloads.clear()
+
+
+images = ImageStore()
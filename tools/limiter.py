@@ -0,0 +1,147 @@
+from tools.metrics import metrics
+import contextlib
+import asyncio
+import time
+
+
+class DomainLimit:
+    """
+    The concurrency state of one Amazon host.
+    """
+
+
+    def __init__(self, initial):
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.waiters = []
+        # Latencies of the successful requests of the current window, and the lowest window p95 seen so far:
+        self.latencies = []
+        self.baseline = None
+        self.last_decrease = 0.0
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of requests in flight per Amazon host and adapts the limit while the crawl runs (AIMD).
+
+    Every successful request raises the limit by 1 / limit, so it grows by about one per round of requests while the
+    host stays healthy. A 503, a robot check page, a timeout or a p95 latency rising past 'tolerance' times the best p95
+    seen cuts the limit by 'backoff'. The limit is cut at most once per round trip, since a wave of 503s answers
+    requests that were all sent before the first cut. The current limit and the requests in flight are exposed as the
+    "amazon_concurrency_limit" and "amazon_requests_in_flight" gauges.
+
+    The controller is off until 'enable' is called, and requests are then not limited at all.
+    """
+
+
+    def __init__(self):
+        self.enabled = False
+        self.domains = {}
+
+
+    def enable(self, initial = 8, minimum = 1, maximum = 64, backoff = 0.5, window = 20, tolerance = 2.0):
+        """
+        Turns the controller on.
+
+        Args:
+            -initial (int): The limit every host starts with.
+            -minimum (int): The lowest limit a host can be cut to.
+            -maximum (int): The highest limit a host can grow to.
+            -backoff (float): The factor the limit is multiplied by when the host shows congestion.
+            -window (int): The number of successful requests the latency p95 is computed over.
+            -tolerance (float): How many times the best p95 seen the current p95 may reach before it counts as congestion.
+        """
+        self.enabled = True
+        self.initial, self.minimum, self.maximum = initial, minimum, maximum
+        self.backoff, self.window, self.tolerance = backoff, window, tolerance
+        self.domains = {}
+
+
+    def state(self, domain):
+        if domain not in self.domains:
+            self.domains[domain] = DomainLimit(self.initial)
+            metrics.set('amazon_concurrency_limit', self.initial, domain = domain)
+        return self.domains[domain]
+
+
+    @contextlib.asynccontextmanager
+    async def slot(self, domain):
+        """
+        Waits until the host is below its limit and holds one of its slots while the request runs.
+
+        Args:
+            -domain (str): The host the request is sent to.
+        """
+        if not self.enabled:
+            yield
+            return
+        state = self.state(domain)
+        while state.in_flight >= int(state.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            state.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in state.waiters:
+                    state.waiters.remove(waiter)
+                raise
+        state.in_flight += 1
+        metrics.set('amazon_requests_in_flight', state.in_flight, domain = domain)
+        try:
+            yield
+        finally:
+            state.in_flight -= 1
+            metrics.set('amazon_requests_in_flight', state.in_flight, domain = domain)
+            self.wake(state)
+
+
+    def wake(self, state):
+        """
+        Wakes as many waiting requests as there are free slots.
+        """
+        for _ in range(max(int(state.limit) - state.in_flight, 0)):
+            while state.waiters and state.waiters[0].done():
+                state.waiters.pop(0)
+            if not state.waiters:
+                break
+            state.waiters.pop(0).set_result(None)
+
+
+    def record(self, domain, seconds, congested):
+        """
+        Adapts the limit of a host to the outcome of one of its requests.
+
+        Args:
+            -domain (str): The host the request was sent to.
+            -seconds (float): The time the request took.
+            -congested (bool): Whether the host answered with a 503 or a robot check page, or timed out.
+        """
+        if not self.enabled:
+            return
+        state = self.state(domain)
+        now = time.monotonic()
+        if not congested:
+            state.latencies.append(seconds)
+            if len(state.latencies) >= self.window:
+                ordered = sorted(state.latencies)
+                p95 = ordered[min(int(round(0.95 * len(ordered))) - 1, len(ordered) - 1)]
+                state.latencies.clear()
+                if state.baseline is None or p95 < state.baseline:
+                    state.baseline = p95
+                elif p95 > state.baseline * self.tolerance:
+                    congested = True
+                    # Let the baseline follow a lasting slowdown instead of cutting the limit forever:
+                    state.baseline *= 1.1
+
+        if congested:
+            # Ignore congestion reported by requests sent before the last cut, it was already accounted for:
+            if now - seconds >= state.last_decrease:
+                state.limit = max(self.minimum, state.limit * self.backoff)
+                state.last_decrease = now
+        else:
+            state.limit = min(self.maximum, state.limit + 1 / state.limit)
+            self.wake(state)
+        metrics.set('amazon_concurrency_limit', round(state.limit, 2), domain = domain)
+
+
+limiter = AdaptiveConcurrency()
@@ -0,0 +1,291 @@
+from tools.transport import ProxyError
+from urllib.parse import urlparse
+import asyncio
+import aiohttp
+import bisect
+import json
+
+
+# Upper bounds in seconds of the latency histogram buckets:
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    A cumulative histogram in the Prometheus style.
+
+    Args:
+        - buckets (tuple): The upper bounds of the buckets, in increasing order.
+    """
+
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        """
+        Records a single value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by linear interpolation inside the bucket that holds it.
+
+        Args:
+            -q (float): The quantile to estimate, between 0 and 1.
+
+        Returns:
+            -float: The estimated value, or 0.0 if nothing was observed.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[idx - 1] if idx else 0.0
+                # Values above the last bucket can only be bounded by the last bucket itself:
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+    def cumulative(self):
+        """
+        Returns (upper bound, cumulative count) pairs, ending with the "+Inf" bucket.
+        """
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """
+    A process-wide registry of counters, gauges and histograms describing a scraping run.
+
+    Every sample carries labels, most importantly the Amazon domain it belongs to. The registry can be served as a
+    Prometheus text endpoint while the scraper runs and saved as a JSON summary at the end of the run.
+    """
+
+
+    def __init__(self):
+        self.families = {}
+
+
+    def register(self, name, kind, description, buckets = LATENCY_BUCKETS):
+        """
+        Declares a metric family.
+
+        Args:
+            -name (str): The Prometheus name of the metric.
+            -kind (str): One of "counter", "gauge" or "histogram".
+            -description (str): The help text of the metric.
+            -buckets (tuple): The bucket bounds, only used by histograms.
+        """
+        self.families[name] = {'kind': kind, 'help': description, 'buckets': buckets, 'samples': {}}
+
+
+    def inc(self, name, value = 1, **labels):
+        """
+        Increments a counter or gauge by the given value.
+        """
+        samples = self.families[name]['samples']
+        key = tuple(sorted(labels.items()))
+        samples[key] = samples.get(key, 0) + value
+
+
+    def dec(self, name, value = 1, **labels):
+        """
+        Decrements a gauge by the given value.
+        """
+        self.inc(name, -value, **labels)
+
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge to the given value.
+        """
+        self.families[name]['samples'][tuple(sorted(labels.items()))] = value
+
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram.
+        """
+        family = self.families[name]
+        key = tuple(sorted(labels.items()))
+        if key not in family['samples']:
+            family['samples'][key] = Histogram(family['buckets'])
+        family['samples'][key].observe(value)
+
+
+    def reset(self):
+        """
+        Drops every recorded sample while keeping the declared metric families.
+        """
+        for family in self.families.values():
+            family['samples'].clear()
+
+
+    def prometheus(self):
+        """
+        Renders the registry in the Prometheus text exposition format.
+
+        Returns:
+            -str: The metrics as text.
+        """
+        def render(labels, extra = ()):
+            pairs = [f'{key}="{value}"' for key, value in labels + extra]
+            return f"{{{','.join(pairs)}}}" if pairs else ''
+
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for labels, sample in family['samples'].items():
+                if family['kind'] == 'histogram':
+                    for bound, count in sample.cumulative():
+                        lines.append(f"{name}_bucket{render(labels, (('le', bound),))} {count}")
+                    lines.append(f"{name}_sum{render(labels)} {sample.sum}")
+                    lines.append(f"{name}_count{render(labels)} {sample.count}")
+                else:
+                    lines.append(f"{name}{render(labels)} {sample}")
+        return '\n'.join(lines) + '\n'
+
+
+    def summary(self):
+        """
+        Summarizes the registry as a JSON friendly dictionary.
+
+        Returns:
+            -dict: For every metric with samples, a list of label sets and their values. Histograms are reduced to
+             count, sum, mean and estimated p50/p95/p99.
+        """
+        results = {}
+        for name, family in self.families.items():
+            if not family['samples']:
+                continue
+            entries = []
+            for labels, sample in family['samples'].items():
+                entry = {'labels': dict(labels)}
+                if family['kind'] == 'histogram':
+                    entry.update({
+                        'count': sample.count,
+                        'sum': round(sample.sum, 4),
+                        'mean': round(sample.sum / sample.count, 4) if sample.count else 0.0,
+                        'p50': round(sample.quantile(0.5), 4),
+                        'p95': round(sample.quantile(0.95), 4),
+                        'p99': round(sample.quantile(0.99), 4),
+                    })
+                else:
+                    entry['value'] = sample
+                entries.append(entry)
+            results[name] = entries
+        return results
+
+
+    def save(self, path):
+        """
+        Writes the JSON summary of the run to a file.
+
+        Args:
+            -path (str): The file to write.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent = 2)
+        print(f"Metrics summary saved to {path}.")
+
+
+    async def serve(self, port = 9100, host = '127.0.0.1'):
+        """
+        Serves the metrics over HTTP from the running event loop.
+
+        "/metrics" returns the Prometheus text format and "/metrics.json" returns the JSON summary.
+
+        Args:
+            -port (int): The port to listen on.
+            -host (str): The interface to bind to, only this machine by default. Pass "0.0.0.0" to let other machines
+             scrape the metrics, which exposes the proxy failures and traffic of the scraper to the network.
+
+        Returns:
+            -aiohttp.web.AppRunner: The runner, call 'cleanup()' on it to stop serving.
+        """
+        # The web server is only imported when the metrics are actually served:
+        from aiohttp import web
+
+        async def prometheus(request):
+            return web.Response(text = self.prometheus(), content_type = 'text/plain', charset = 'utf-8')
+
+        async def summary(request):
+            return web.json_response(self.summary())
+
+        app = web.Application()
+        app.router.add_get('/metrics', prometheus)
+        app.router.add_get('/metrics.json', summary)
+        runner = web.AppRunner(app, access_log = None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        return runner
+
+
+def host(url):
+    """
+    Returns the host name of a URL, used as the "domain" label of the metrics.
+    """
+    return urlparse(url).hostname or ''
+
+
+def retry_cause(error, response = None):
+    """
+    Classifies why a page had to be retried.
+
+    Args:
+        -error (Exception): The exception raised while fetching or parsing the page.
+        -response (Response): The response the page was fetched with, if any.
+
+    Returns:
+        -str: "http_<status>" for a status other than 200, e.g. "http_503" or "http_404", or one of "robot_check",
+         "proxy", "timeout", "connection" or "parse".
+    """
+    if response is not None and response.status not in (None, 200):
+        return f"http_{response.status}"
+    if response is not None and response.robot_check:
+        return 'robot_check'
+    if isinstance(error, (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError, ProxyError)):
+        return 'proxy'
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, (aiohttp.ClientError, ConnectionError)):
+        return 'connection'
+    return 'parse'
+
+
+metrics = Metrics()
+metrics.register('amazon_fetch_seconds', 'histogram', "Time to download a page, from sending the request to reading the whole body.")
+metrics.register('amazon_parse_seconds', 'histogram', "Time to parse a downloaded page and extract its fields.")
+metrics.register('amazon_bytes_downloaded_total', 'counter', "Bytes of page content downloaded.")
+metrics.register('amazon_early_stops_total', 'counter', "Streamed pages whose download was stopped early, by reason (selectors or byte_cap).")
+metrics.register('amazon_http_responses_total', 'counter', "HTTP responses received, by status code.")
+metrics.register('amazon_retries_total', 'counter', "Page retries, by cause.")
+metrics.register('amazon_proxy_failures_total', 'counter', "Requests that failed because the proxy could not be reached or refused them.")
+metrics.register('amazon_concurrency_limit', 'gauge', "Current adaptive limit of requests in flight, by domain.")
+metrics.register('amazon_requests_in_flight', 'gauge', "Requests currently holding a slot of the adaptive concurrency limit, by domain.")
+metrics.register('amazon_queue_depth', 'gauge', "Pages scheduled for scraping that have not finished yet, by stage.")
+metrics.register('amazon_records_exported_total', 'counter', "Product records written to a sink.")
+metrics.register('amazon_selector_hits_total', 'counter', "Fields found on a page, by field and by the position of the matching alternative in its fallback chain.")
+metrics.register('amazon_images_total', 'counter', "Product image URLs handled by the image store, by outcome (downloaded, duplicate_url, duplicate_content or failed).")
+metrics.register('amazon_image_bytes_total', 'counter', "Bytes of product images written to the image store.")
+metrics.register('amazon_changes_total', 'counter', "Products written to the change feed, by operation (new, removed or modified).")
+metrics.register('amazon_hedged_requests_total', 'counter', "Duplicates of slow requests, by outcome (won, lost, failed or over_budget when the budget held one back).")
+metrics.register('amazon_hedge_deadline_seconds', 'gauge', "Time after which a request is duplicated through another proxy, by domain.")
@@ -0,0 +1,94 @@
+from cssselect import HTMLTranslator
+from lxml.cssselect import CSSSelector
+from lxml import etree
+
+
+class SelectorWatch:
+    """
+    Watches an HTML document being parsed incrementally and tells when every needed selector has fully arrived.
+
+    Body chunks are fed into lxml's incremental HTML parser as they are downloaded. A selector is complete once its first
+    match is closed, or, for descendant selectors like "ul.list li", once the nearest ancestor matching the first part
+    of the selector ("ul.list") is closed, so that repeated items after the first one are included as well.
+
+    A needed field can also be given as a list of alternative selectors in order of priority. It is complete as soon as
+    the first one is, the others are fallbacks for pages where it never appears, which are read up to 'until'.
+
+    Args:
+        - selectors (list): The CSS selectors whose content is needed, or lists of alternatives.
+        - until (str): An optional CSS selector of an element after which nothing needed can appear. The document is
+          complete as soon as that element is closed, even if some selectors never matched.
+    """
+
+
+    def __init__(self, selectors, until = None):
+        translator = HTMLTranslator()
+        self.pending = {}
+        for group in selectors:
+            # Only the first alternative of a group decides when it is complete:
+            selector = group if isinstance(group, str) else group[0]
+            first = selector.split()[0]
+            container = translator.css_to_xpath(first, prefix = 'ancestor::') if first != selector else None
+            self.pending[selector] = (CSSSelector(selector, translator = 'html'), container and etree.XPath(container))
+        self.until = CSSSelector(until, translator = 'html') if until else None
+        self.parser = etree.HTMLPullParser(events = ('start',))
+        self.root = None
+
+
+    @staticmethod
+    def closed(element):
+        """
+        Returns True once the parser has moved past the end of the element.
+
+        Parsing is sequential, so the element is closed as soon as anything follows it or one of its ancestors.
+        """
+        for node in [element, *element.iterancestors()]:
+            if node.getnext() is not None or node.tail is not None:
+                return True
+        return False
+
+
+    def feed(self, chunk):
+        """
+        Feeds a chunk of the body to the parser.
+
+        Args:
+            -chunk (bytes): The next piece of the document.
+
+        Returns:
+            -bool: True once every needed selector is complete and the rest of the body can be skipped.
+        """
+        self.parser.feed(chunk)
+        if self.root is None:
+            for _, element in self.parser.read_events():
+                self.root = element.getroottree().getroot()
+                break
+            if self.root is None:
+                return False
+        else:
+            # Nothing is done with the events, drain them so they don't pile up:
+            for _ in self.parser.read_events():
+                pass
+
+        if self.until is not None and any(self.closed(element) for element in self.until(self.root)):
+            return True
+
+        for selector, (match, container) in list(self.pending.items()):
+            if self.complete(match, container):
+                del self.pending[selector]
+        return not self.pending
+
+
+    def complete(self, match, container):
+        """
+        Returns True once the first match of a selector, or its matching container, is closed.
+        """
+        found = match(self.root)
+        if not found:
+            return False
+        element = found[0]
+        if container is not None:
+            # The nearest matching ancestor is the last one in document order:
+            ancestors = container(element)
+            element = ancestors[-1] if ancestors else element
+        return self.closed(element)
@@ -1,36 +1,165 @@
-from fake_useragent import UserAgent
+from tools.metrics import metrics, host
+from tools.trace import tracer
+from tools.archive import archive
+from tools.transport import transport, ProxyError
+from tools.limiter import limiter
+from tools.hedging import hedging
 from urllib.parse import urlparse
-import pandas as pd
+import functools
 import itertools
+import asyncio
 import aiohttp
 import secrets
+import time
 import yaml
 import re
 import os
 
 
+# Marker of the captcha page Amazon serves instead of the requested page when it suspects a bot:
+ROBOT_CHECK = b'/errors/validateCaptcha'
+
+# Size of the body chunks fed to the incremental parser when a page is streamed:
+CHUNK_SIZE = 16 * 1024
+
+# User agent database of the process, loaded by the first call to 'userAgents':
+_user_agents = None
+
+
 class Response:
-    def __init__(self, base_url):
+    def __init__(self, base_url, proxy = None):
         """
         Initializes the Response class with a base URL.
 
         Parameters:
         - base_url (str): The base URL for the HTTP requests.
+        - proxy (str): The proxy to route the HTTP requests through, or None for a direct connection.
         """
         self.base_url = base_url
+        self.proxy = proxy
+
+        # Filled in once the response has been received:
+        self.status = None
+        self.robot_check = False
 
-    async def content(self):
+    async def content(self, selectors = None, until = None, byte_cap = None):
         """
         Asynchronously retrieves the content of the response from the specified URL.
 
+        When selectors, an end marker or a byte cap are given, the body is streamed through an incremental parser instead,
+        and the response is closed as soon as every selector has fully arrived, the end marker element is closed or the
+        byte cap is reached. The trailing part of the page is then neither downloaded nor parsed. While the page archive
+        is open, pages are always read whole and appended to it. When adaptive concurrency is on, the request first waits
+        for a free slot of its host and reports its latency and outcome back to the controller. A request taking longer
+        than the timeout of 'hedging' raises asyncio.TimeoutError, and with hedging on a request still unanswered at the
+        deadline of its host is duplicated through another proxy, the first good response being returned.
+
+        Parameters:
+        - selectors (list): CSS selectors whose content is needed.
+        - until (str): CSS selector of an element after which nothing needed can appear.
+        - byte_cap (int): The maximum number of body bytes to read.
+
+        Returns:
+        - bytes: The content of the HTTP response, or the part of it that was read.
+        """
+        domain = host(self.base_url)
+        result, proxy = await hedging.run(domain, self.proxy, lambda proxy, sent: self.attempt(proxy, sent, selectors, until, byte_cap),
+                                          lambda result: result[0] == 200 and ROBOT_CHECK not in result[1])
+        self.status, cont, seconds = result
+        self.robot_check = ROBOT_CHECK in cont
+        archive.append(self.base_url, cont, self.status, self.robot_check)
+        tracer.mark('proxy', proxy)
+        tracer.mark('body_end')
+        tracer.mark('status', self.status)
+        tracer.mark('bytes', len(cont))
+
+        # Record the download in the run metrics:
+        metrics.observe('amazon_fetch_seconds', seconds, domain = domain)
+        metrics.inc('amazon_bytes_downloaded_total', len(cont), domain = domain)
+        metrics.inc('amazon_http_responses_total', domain = domain, status = str(self.status))
+        return cont
+
+    async def attempt(self, proxy, sent, selectors, until, byte_cap):
+        """
+        Sends the request once through the given proxy.
+
+        Parameters:
+        - proxy (str): The proxy to route the request through, or None for a direct connection.
+        - sent (callable): Called once the request got its concurrency slot and is sent.
+        - selectors (list): CSS selectors whose content is needed.
+        - until (str): CSS selector of an element after which nothing needed can appear.
+        - byte_cap (int): The maximum number of body bytes to read.
+
+        Returns:
+        - tuple: The status code, the content that was read and the time the request took in seconds.
+        """
+        domain = host(self.base_url)
+        tracer.mark('slot_start')
+        async with limiter.slot(domain):
+            tracer.mark('slot_end')
+            sent()
+            start = time.perf_counter()
+            tracer.mark('attempt_start')
+            tracer.mark('transport', transport.backend.name)
+
+            # Both backends decompress gzip and deflate bodies chunk by chunk, so streamed pages are still sent compressed:
+            headers = {'User-Agent': userAgents(), 'Accept-Encoding': 'gzip, deflate'}
+            tracer.mark('proxy', proxy)
+            tracer.mark('identity', headers['User-Agent'])
+            try:
+                status, cont = await hedging.limit(self.download(headers, proxy, selectors, until, byte_cap))
+            except (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError, ProxyError):
+                metrics.inc('amazon_proxy_failures_total', domain = domain)
+                raise
+            except asyncio.TimeoutError:
+                limiter.record(domain, time.perf_counter() - start, True)
+                raise
+            limiter.record(domain, time.perf_counter() - start, status == 503 or ROBOT_CHECK in cont)
+        return status, cont, time.perf_counter() - start
+
+    async def download(self, headers, proxy, selectors, until, byte_cap):
+        """
+        Receives the page, or the part of it that is needed.
+
+        Returns:
+        - tuple: The status code and the content that was read.
+        """
+        async with transport.get(self.base_url, headers, proxy, tracer.current()) as resp:
+            # Archived pages are always read whole, so they can be re-extracted with any future selectors:
+            if (selectors or until or byte_cap) and not archive.enabled:
+                return resp.status, await self.stream(resp, selectors or [], until, byte_cap)
+            return resp.status, await resp.read()
+
+    async def stream(self, resp, selectors, until, byte_cap):
+        """
+        Reads the body of a response chunk by chunk until the needed part of the page has arrived.
+
+        Parameters:
+        - resp: The response to read, as yielded by the transport.
+        - selectors (list): CSS selectors whose content is needed.
+        - until (str): CSS selector of an element after which nothing needed can appear.
+        - byte_cap (int): The maximum number of body bytes to read, or None for no limit.
+
         Returns:
-        - bytes: The content of the HTTP response.
+        - bytes: The part of the body that was read.
         """
-        async with aiohttp.ClientSession() as session:
-            headers = {'User-Agent': userAgents()}
-            async with session.get(self.base_url, headers = headers) as resp:
-                cont = await resp.read()
-                return cont
+        # The incremental parser is only loaded once a page is actually streamed:
+        from tools.streaming import SelectorWatch
+
+        watch = SelectorWatch(selectors, until)
+        chunks = []
+        size = 0
+        async for chunk in resp.iter_chunked(CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            reason = 'selectors' if watch.feed(chunk) else 'byte_cap' if byte_cap and size >= byte_cap else None
+            if reason:
+                # Stop the transfer rather than draining the rest of the body:
+                if not resp.at_eof():
+                    await resp.close()
+                    metrics.inc('amazon_early_stops_total', domain = host(self.base_url), reason = reason)
+                break
+        return b''.join(chunks)
 
     async def response(self):
         """
@@ -39,11 +168,11 @@ class Response:
         Returns:
         - int: The HTTP status code of the response.
         """
-        async with aiohttp.ClientSession() as session:
-            headers = {'User-Agent': userAgents()}
-            async with session.get(self.base_url, headers = headers) as resp:
-                cont = resp.status
-                return cont
+        headers = {'User-Agent': userAgents()}
+        async with transport.get(self.base_url, headers, self.proxy) as resp:
+            cont = resp.status
+            metrics.inc('amazon_http_responses_total', domain = host(self.base_url), status = str(cont))
+            return cont
 
 
 class TryExcept:
@@ -138,6 +267,20 @@ def domain(url):
     return dom
 
 
+def origin(url):
+    """
+    Extract the scheme and network location of a given URL.
+
+    Args:
+    - url (str): The URL from which to extract the origin.
+
+    Returns:
+    - str: The origin of the URL, e.g. "https://www.amazon.com".
+    """
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
 def flat(d_lists):
     """
     Flatten a multi-dimentional list.
@@ -210,6 +353,43 @@ def region(url):
     return domain_lists[raw_domain]
 
 
+# Amazon host of every region, keyed by the country name returned by 'region':
+AMAZON_HOSTS = {
+    'USA': 'www.amazon.com',
+    'UK': 'www.amazon.co.uk',
+    'Mexico': 'www.amazon.com.mx',
+    'Brazil': 'www.amazon.com.br',
+    'Australia': 'www.amazon.com.au',
+    'Japan': 'www.amazon.co.jp',
+    'Belgium': 'www.amazon.com.be',
+    'India': 'www.amazon.in',
+    'France': 'www.amazon.fr',
+    'Sweden': 'www.amazon.se',
+    'Germany': 'www.amazon.de',
+    'Italy': 'www.amazon.it',
+    'UAE': 'www.amazon.ae',
+}
+
+
+def region_origin(name):
+    """
+    Returns the origin of the Amazon site of a region.
+
+    Args:
+    - name (str): A country name as returned by 'region' ("USA", "UK", ...) or a domain suffix ("com", "co.uk", ...), in any case.
+
+    Returns:
+    - str: The origin of the Amazon site, e.g. "https://www.amazon.co.uk".
+
+    Raises:
+    - KeyError: If the region is not one of the supported Amazon sites.
+    """
+    for country, amazon_host in AMAZON_HOSTS.items():
+        if name.lower() in (country.lower(), amazon_host.split('amazon.', 1)[1]):
+            return f"https://{amazon_host}"
+    raise KeyError(f"Unknown Amazon region: {name}")
+
+
 def random_values(d_lists):
     """
     Returns a random value from a list.
@@ -262,6 +442,9 @@ async def export_sheet(dicts, name):
     # Create the directory if it doesn't exist:
     await create_path(directory_name)
 
+    # Imported here so that runs which never export a sheet don't pay for loading pandas:
+    import pandas as pd
+
     # Convert the list of dictionaries to a pandas DataFrame:
     df = pd.DataFrame(dicts)
 
@@ -293,14 +476,19 @@ def userAgents():
     """
     Returns a random user agent string from a file containing a list of user agents.
 
+    The user agent database is loaded once per process, on the first call.
+
     Args:
         -None
 
     Returns:
         -A string representing a ranom user agent.
     """
-    agents = UserAgent()
-    return agents.random
+    global _user_agents
+    if _user_agents is None:
+        from fake_useragent import UserAgent
+        _user_agents = UserAgent()
+    return _user_agents.random
 
 
 def rand_proxies():
@@ -322,10 +510,13 @@ def rand_proxies():
         return random_values(proxies)
 
 
+@functools.lru_cache(maxsize = None)
 def yaml_load(selectors):
     """
     Loads a YAML file containing selectors for web scraping.
 
+    The file is read once per process, every later call returns the same dictionary, so it must not be modified.
+
     Args:
         -selectors: A string representing the name of the YAML file containing the selectors.
 
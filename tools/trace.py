@@ -0,0 +1,250 @@
+import contextvars
+import argparse
+import aiohttp
+import json
+import time
+
+
+# Trace event of the page being scraped by the current task:
+_current = contextvars.ContextVar('trace_event', default = None)
+
+# Default value of 'mark', so that None can still be recorded, e.g. as the proxy of a direct connection:
+_NOW = object()
+
+
+class Tracer:
+    """
+    Writes one JSONL event per scraped URL describing where its time went.
+
+    Tracing is off until 'enable' is called, and every hook returns immediately while it is off. An event holds epoch
+    timestamps for queueing, the start of the last attempt, DNS, connect, first byte, body complete, the random sleep,
+    parse start/end and the sink write, together with the proxy, user agent, retry count and outcome of the page.
+    Timings of the network phases are those of the last attempt.
+    """
+
+
+    def __init__(self):
+        self.file = None
+        self.queued = {}
+        self.pending = []
+        self.trace_config = None
+
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+
+    def enable(self, path):
+        """
+        Starts tracing, appending events to the given file.
+
+        Args:
+            -path (str): The JSONL file to write the events to.
+        """
+        self.file = open(path, 'a')
+        self.trace_config = aiohttp.TraceConfig()
+        for signal, name in (('on_dns_resolvehost_start', 'dns_start'), ('on_dns_resolvehost_end', 'dns_end'),
+                             ('on_connection_create_start', 'connect_start'), ('on_connection_create_end', 'connect_end'),
+                             ('on_connection_reuseconn', 'connection_reused'), ('on_request_start', 'request_start'),
+                             ('on_request_end', 'first_byte')):
+            getattr(self.trace_config, signal).append(self.hook(name))
+
+
+    def hook(self, name):
+        """
+        Builds an aiohttp trace callback that stamps the given field of the event passed as 'trace_request_ctx'.
+        """
+        async def callback(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx[name] = time.time()
+        return callback
+
+
+    def queue(self, url):
+        """
+        Records the moment a URL is scheduled for scraping.
+        """
+        if self.enabled:
+            self.queued[url] = time.time()
+
+
+    def begin(self, url, stage):
+        """
+        Opens the event of a URL and makes it the current event of the running task.
+
+        Args:
+            -url (str): The URL being scraped.
+            -stage (str): The crawl stage of the page, "search" or "product".
+
+        Returns:
+            -dict: The event, or None while tracing is off.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        event = {'url': url, 'stage': stage, 'queued': self.queued.pop(url, now), 'start': now, 'retries': 0, 'causes': []}
+        _current.set(event)
+        return event
+
+
+    def current(self):
+        """
+        Returns the event of the page being scraped by the running task, if any.
+        """
+        return _current.get() if self.enabled else None
+
+
+    def detach(self):
+        """
+        Stops the running task from recording into the event it inherited, e.g. a duplicate of the traced request.
+        """
+        _current.set(None)
+
+
+    def mark(self, name, value = _NOW):
+        """
+        Stamps a field of the current event with the current time, or with the given value.
+        """
+        event = self.current()
+        if event is not None:
+            event[name] = time.time() if value is _NOW else value
+
+
+    def retry(self, cause):
+        """
+        Counts a failed attempt of the current page.
+        """
+        event = self.current()
+        if event is not None:
+            event['retries'] += 1
+            event['causes'].append(cause)
+
+
+    def finish(self, outcome, hold = False):
+        """
+        Closes the current event.
+
+        Args:
+            -outcome (str): "ok", or a description of why the page failed.
+            -hold (bool): Keep the event until the record is written to a sink with 'sink', instead of writing it now.
+        """
+        event = self.current()
+        if event is None:
+            return
+        event['end'] = time.time()
+        event['outcome'] = outcome
+        _current.set(None)
+        if hold and outcome == 'ok':
+            self.pending.append(event)
+        else:
+            self.write(event)
+
+
+    def sink(self, name):
+        """
+        Stamps every held event with the time its record was written to a sink and writes the events out.
+
+        Args:
+            -name (str): The name of the sink, e.g. "csv" or "mongo".
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        for event in self.pending:
+            event['sink'] = name
+            event['sink_write'] = now
+            self.write(event)
+        self.pending.clear()
+
+
+    def write(self, event):
+        self.file.write(json.dumps(event) + '\n')
+
+
+    def close(self):
+        """
+        Writes any held events and stops tracing.
+        """
+        if not self.enabled:
+            return
+        for event in self.pending:
+            self.write(event)
+        self.pending.clear()
+        self.file.close()
+        self.file = None
+
+
+tracer = Tracer()
+
+
+# Phases reported by the summary, as (name, start field, end field):
+PHASES = (
+    ('queue', 'queued', 'start'),
+    ('retries', 'start', 'slot_start'),
+    ('throttle', 'slot_start', 'slot_end'),
+    ('dns', 'dns_start', 'dns_end'),
+    ('connect', 'connect_start', 'connect_end'),
+    ('first_byte', 'request_start', 'first_byte'),
+    ('body', 'first_byte', 'body_end'),
+    ('sleep', 'sleep_start', 'sleep_end'),
+    ('parse', 'parse_start', 'parse_end'),
+    ('sink', 'end', 'sink_write'),
+    ('total', 'queued', 'end'),
+)
+
+
+def phases(event):
+    """
+    Returns the duration in seconds of every phase present in a trace event.
+    """
+    return {name: event[end] - event[start] for name, start, end in PHASES if start in event and end in event}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(max(int(round(pct / 100 * len(ordered))) - 1, 0), len(ordered) - 1)]
+
+
+def summarize(path, top = 10):
+    """
+    Prints tail latency per phase and the slowest URLs of a trace file.
+
+    Args:
+        -path (str): The JSONL trace file.
+        -top (int): The number of slowest URLs to list.
+    """
+    with open(path) as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    if not events:
+        print("The trace file is empty.")
+        return
+
+    durations = [phases(event) for event in events]
+    outcomes = {}
+    for event in events:
+        outcomes[event.get('outcome', 'unfinished')] = outcomes.get(event.get('outcome', 'unfinished'), 0) + 1
+    print(f"{len(events)} URLs | retries: {sum(event['retries'] for event in events)} | outcomes: {outcomes}")
+
+    print(f"\n{'phase':<12}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, _, _ in PHASES:
+        values = [duration[name] for duration in durations if name in duration]
+        if values:
+            print(f"{name:<12}{len(values):>7}" + ''.join(f"{percentile(values, pct) * 1000:>10.1f}" for pct in (50, 90, 99, 100)))
+
+    print(f"\nSlowest {top} URLs:")
+    ranked = sorted(zip(events, durations), key = lambda pair: pair[1].get('total', 0), reverse = True)
+    for event, duration in ranked[:top]:
+        # Name the phase that took the biggest share of the page's time, the sink wait is shared by the whole batch:
+        parts = {name: value for name, value in duration.items() if name not in ('total', 'sink')}
+        worst = max(parts, key = parts.get) if parts else 'n/a'
+        print(f"{duration.get('total', 0) * 1000:>10.1f} ms  {worst:<10} retries={event['retries']:<3} "
+              f"proxy={event.get('proxy')}  {event['url']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Summarize a scraper trace file.")
+    parser.add_argument('path', help = "The JSONL trace file written by the scraper.")
+    parser.add_argument('--top', type = int, default = 10, help = "Number of slowest URLs to list.")
+    args = parser.parse_args()
+    summarize(args.path, args.top)
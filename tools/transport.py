@@ -0,0 +1,244 @@
+from tools.trace import tracer
+import contextlib
+import asyncio
+import aiohttp
+import time
+
+
+class ProxyError(ConnectionError):
+    """
+    Raised by the HTTP/2 backend when the proxy can't be reached or refuses the request.
+    """
+
+
+class AiohttpPage:
+    """
+    The body of a response received through aiohttp.
+    """
+
+
+    def __init__(self, resp):
+        self.resp = resp
+        self.status = resp.status
+
+
+    async def read(self):
+        return await self.resp.read()
+
+
+    def iter_chunked(self, size):
+        return self.resp.content.iter_chunked(size)
+
+
+    def at_eof(self):
+        return self.resp.content.at_eof()
+
+
+    async def close(self):
+        # Drops the connection, the rest of the body is never read:
+        self.resp.close()
+
+
+class Http2Page:
+    """
+    The body of a response received through httpx.
+    """
+
+
+    def __init__(self, resp):
+        self.resp = resp
+        self.status = resp.status_code
+        self.consumed = False
+
+
+    async def read(self):
+        return await self.resp.aread()
+
+
+    async def iter_chunked(self, size):
+        async for chunk in self.resp.aiter_bytes(size):
+            yield chunk
+        self.consumed = True
+
+
+    def at_eof(self):
+        return self.consumed
+
+
+    async def close(self):
+        # Resets only this stream, the connection stays open for the other requests multiplexed over it:
+        await self.resp.aclose()
+
+
+class AiohttpTransport:
+    """
+    Fetches pages over HTTP/1.1 with aiohttp, opening a new connection for every request.
+
+    Args:
+        - uds (str): An optional Unix socket every request is sent to, whatever the host of the URL, used to reach local test servers.
+    """
+
+
+    name = 'aiohttp'
+
+
+    def __init__(self, uds = None):
+        self.uds = uds
+
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, headers, proxy = None, trace = None):
+        # Only hook into aiohttp's request life cycle when the page is being traced:
+        trace_configs = [tracer.trace_config] if trace is not None else None
+        connector = aiohttp.UnixConnector(self.uds) if self.uds else None
+        async with aiohttp.ClientSession(trace_configs = trace_configs, connector = connector) as session:
+            async with session.get(url, headers = headers, proxy = proxy, trace_request_ctx = trace) as resp:
+                yield AiohttpPage(resp)
+
+
+    async def close(self):
+        pass
+
+
+class Http2Transport:
+    """
+    Fetches pages with httpx, multiplexing concurrent requests to the same host over a few HTTP/2 connections.
+
+    One client is kept per proxy and event loop. A client opens a new connection only once the server's limit of
+    concurrent streams is reached on the open ones, and never more than 'max_connections'. Hosts that don't negotiate
+    HTTP/2 are still served over HTTP/1.1.
+
+    Args:
+        - uds (str): An optional Unix socket every request is sent to, whatever the host of the URL. The server behind
+          it is spoken to with HTTP/2 prior knowledge (h2c), as local test servers don't use TLS.
+        - max_connections (int): The maximum number of connections of a client.
+    """
+
+
+    name = 'http2'
+
+
+    def __init__(self, uds = None, max_connections = 20):
+        # httpx and h2 are only needed when this backend is used:
+        import httpx
+        self.httpx = httpx
+        self.uds = uds
+        self.max_connections = max_connections
+        self.clients = {}
+
+
+    def client(self, proxy):
+        """
+        Returns the client of the running event loop for a proxy, creating it on first use.
+        """
+        loop = asyncio.get_running_loop()
+        # Clients are bound to the loop they were created in, forget the ones of finished loops:
+        for key in [key for key in self.clients if key[0].is_closed()]:
+            del self.clients[key]
+        if (loop, proxy) not in self.clients:
+            httpx = self.httpx
+            limits = httpx.Limits(max_connections = self.max_connections, max_keepalive_connections = self.max_connections)
+            # Same limits as aiohttp's defaults, httpx would give up after 5 seconds:
+            timeout = httpx.Timeout(300, connect = 30)
+            if self.uds:
+                transport = httpx.AsyncHTTPTransport(http1 = False, http2 = True, uds = self.uds, limits = limits)
+                client = httpx.AsyncClient(transport = transport, timeout = timeout)
+            else:
+                client = httpx.AsyncClient(http2 = True, proxy = proxy, limits = limits, timeout = timeout)
+            self.clients[(loop, proxy)] = client
+        return self.clients[(loop, proxy)]
+
+
+    def hook(self, trace):
+        """
+        Builds an httpcore trace callback that stamps the connection and request phases of the event being traced.
+        """
+        fields = {
+            'connection.connect_tcp.started': 'connect_start',
+            'connection.connect_unix_socket.started': 'connect_start',
+            'connection.connect_tcp.complete': 'connect_end',
+            'connection.connect_unix_socket.complete': 'connect_end',
+            'http11.send_request_headers.started': 'request_start',
+            'http2.send_request_headers.started': 'request_start',
+            'http11.receive_response_headers.complete': 'first_byte',
+            'http2.receive_response_headers.complete': 'first_byte',
+        }
+
+        async def callback(name, info):
+            if name in fields:
+                trace[fields[name]] = time.time()
+        return callback
+
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, headers, proxy = None, trace = None):
+        httpx = self.httpx
+        extensions = {'trace': self.hook(trace)} if trace is not None else None
+        try:
+            async with self.client(proxy).stream('GET', url, headers = headers, extensions = extensions) as resp:
+                yield Http2Page(resp)
+        # Surface failures as the exceptions the rest of the scraper already classifies:
+        except httpx.ProxyError as e:
+            raise ProxyError(str(e)) from e
+        except httpx.TimeoutException as e:
+            raise asyncio.TimeoutError(str(e)) from e
+        except httpx.TransportError as e:
+            raise ConnectionError(str(e)) from e
+
+
+    async def close(self):
+        """
+        Closes the clients of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        for key in [key for key in self.clients if key[0] is loop]:
+            await self.clients.pop(key).aclose()
+
+
+class Transport:
+    """
+    The backend used by 'Response' to fetch pages, aiohttp over HTTP/1.1 until 'use' selects another one.
+    """
+
+
+    backends = {'aiohttp': AiohttpTransport, 'http2': Http2Transport}
+
+
+    def __init__(self):
+        self.backend = AiohttpTransport()
+
+
+    def use(self, name, **options):
+        """
+        Selects the backend of every following request.
+
+        Args:
+            -name (str): "aiohttp" or "http2".
+            -options: Passed to the backend, e.g. 'uds' or 'max_connections'.
+        """
+        self.backend = self.backends[name](**options)
+        return self.backend
+
+
+    def get(self, url, headers, proxy = None, trace = None):
+        """
+        Sends a GET request through the selected backend.
+
+        Args:
+            -url (str): The URL to fetch.
+            -headers (dict): The request headers.
+            -proxy (str): The proxy to route the request through, or None for a direct connection.
+            -trace (dict): The trace event of the page, if it is being traced.
+
+        Returns:
+            -An async context manager yielding the response, with a 'status', 'read()', 'iter_chunked(size)',
+             'at_eof()' and 'close()'.
+        """
+        return self.backend.get(url, headers, proxy, trace)
+
+
+    async def close(self):
+        await self.backend.close()
+
+
+transport = Transport()